@@ -0,0 +1,412 @@
+
+import argparse
+import json
+import platform
+import random
+import struct
+import sys
+import time
+import tracemalloc
+
+import script_diff
+import script_editing
+from script_editing import FlowKind, OpcodeTables, get_opcode_tables
+
+
+DISASSEMBLY_PHASES = ("tables", "header", "walk", "gaps", "emit")
+ASSEMBLY_PHASES = ("parse", "encode", "link")
+STRESS_KINDS = ("data", "overlap", "targets")
+# largest allowed growth of the analysis time per byte from the smallest to the largest stress file
+STRESS_LIMIT = 3.0
+BRANCH = struct.Struct("<HBI")
+# VMNop at any alignment, then VMHalt at any alignment, so every walk into the end of a file stops cleanly
+STRESS_TAIL = bytes(8) + b"\x02\x00\x00\x02\x00" + bytes(8)
+# command inserted into the edited files of the diff benchmark
+DIFF_INSERT = "    VMSleep 1"
+
+
+def random_param(rng: random.Random, width: int) -> str:
+    if width == 1:
+        return str(rng.randrange(0x100))
+    if width == 4:
+        return str(rng.randrange(0x100000000))
+    r = rng.random()
+    if r < 0.2:
+        return hex(rng.randrange(0x4000, 0x4200))
+    if r < 0.3:
+        return hex(rng.randrange(0x8000, 0x8100))
+    return str(rng.randrange(0x4000))
+
+
+def generate_asm(rng: random.Random, tables: OpcodeTables, scripts: int, commands: int, branch_density: float,
+                 raw_tail: int = 0) -> list[str]:
+    """
+    Generate the lines of a valid .asm file with the given number of scripts and commands per script.
+    branch_density is the share of commands that are jumps, calls or actor commands.
+    """
+    plain = [op for op in tables.commands.by_code.values() if op.flow == FlowKind.NONE]
+    actions = [op for op in tables.actions.by_code.values() if op.code != script_editing.END_ACTION]
+    lines = [f"{script} scr{script}" for script in range(scripts)]
+    lines.append("# commands")
+    # subroutines and action lists, written after all scripts
+    extra: list[tuple[str, str]] = []
+
+    def plain_command() -> str:
+        op = rng.choice(plain)
+        return " ".join([f"    {op.name}", *(random_param(rng, width) for width in op.widths)])
+
+    for script in range(scripts):
+        lines.append(f"# scr{script}")
+        pending_labels = []
+        for i in range(commands):
+            if rng.random() >= branch_density:
+                lines.append(plain_command())
+                continue
+            match rng.randrange(5):
+                case 0:
+                    if len(extra) > 0 and rng.random() < 0.5 and extra[-1][0] == "sub":
+                        label = extra[-1][1]
+                    else:
+                        label = f"sub{len(extra)}"
+                        extra.append(("sub", label))
+                    lines.append(f"    VMCall {label}")
+                case 1:
+                    label = f"sub{len(extra)}"
+                    extra.append(("sub", label))
+                    lines.append(f"    VMCallIf {rng.randrange(6)} {label}")
+                case 2:
+                    label = f"act{len(extra)}"
+                    extra.append(("act", label))
+                    lines.append(f"    ActorCmdExec {random_param(rng, 2)} {label}")
+                case 3:
+                    label = f"lbl{script}-{len(pending_labels)}"
+                    pending_labels.append(label)
+                    lines.append(f"    VMJumpIf {rng.randrange(6)} {label}")
+                case _:
+                    label = f"lbl{script}-{len(pending_labels)}"
+                    pending_labels.append(label)
+                    lines.append(f"    VMJump {label}")
+                    lines.append(f"# {label}")
+                    pending_labels.pop()
+        lines.append("    VMHalt")
+        for label in pending_labels:
+            lines.append(f"# {label}")
+            lines.append(plain_command())
+            lines.append("    VMHalt")
+    for kind, label in extra:
+        lines.append(f"# {label}")
+        if kind == "sub":
+            lines.extend(plain_command() for _ in range(rng.randrange(1, 6)))
+            lines.append("    VMReturn")
+        else:
+            lines.extend(f"     {rng.choice(actions).name} {rng.randrange(16)}" for _ in range(rng.randrange(6)))
+            lines.append("     EndAction 0")
+    lines.extend(f"    _{hex(rng.randrange(0x100))}" for _ in range(raw_tail))
+    return lines
+
+
+def generate_corpus(seed: int, sizes: list[int], densities: list[float], files: int,
+                    tables: OpcodeTables) -> dict[str, list[bytes]]:
+    """
+    Generate script files for every combination of size (commands per script) and branch density.
+    """
+    rng = random.Random(seed)
+    corpus = {}
+    for size in sizes:
+        for density in densities:
+            corpus[f"synthetic-{size}-{density}"] = [
+                bytes(script_editing.assemble_lines(generate_asm(rng, tables, rng.randrange(1, 16), size, density,
+                                                                 rng.randrange(16)), tables))
+                for _ in range(files)
+            ]
+    return corpus
+
+
+def generate_pathological(rng: random.Random, kind: str, size: int) -> bytes:
+    """
+    Generate a script file of about size bytes that is hard on the structure analysis:
+    "data" is random bytes that all decode as valid commands, entered by many scripts at random offsets, like a data
+    region disassembled by mistake; "overlap" is a run of conditional jumps and calls into random, mostly misaligned
+    offsets of a block of VMNop; "targets" is a run of conditional jumps to every command of a block of VMNop.
+    """
+    if kind == "data":
+        # 0x0000, 0x0001, 0x0100 and 0x0101 are all commands without control flow
+        code = bytes(rng.choice((0, 1)) for _ in range(size))
+        entries = [rng.randrange(size) for _ in range(size // 8)]
+    else:
+        count = size // (2 * BRANCH.size)
+        sled = size // 2 if kind == "overlap" else 2 * count
+        start = 6 + BRANCH.size * count + 2
+        branches = bytearray()
+        for i in range(count):
+            target = start + (rng.randrange(sled) if kind == "overlap" else 2 * i)
+            end = 6 + len(branches) + BRANCH.size
+            branches += BRANCH.pack(rng.choice((0x1f, 0x20)), rng.randrange(6), (target - end) % 0x100000000)
+        code = branches + b"\x02\x00" + bytes(sled)
+        entries = [0]
+    table = b"".join(struct.pack("<I", len(entries) * 4 + 2 + entry - 4 * i - 4) for i, entry in enumerate(entries))
+    return table + b"\x13\xfd" + code + STRESS_TAIL
+
+
+def edit_asm(rng: random.Random, lines: list[str], retarget: bool) -> tuple[list[str], bool]:
+    """
+    Edit the disassembly of a file: insert DIFF_INSERT before a random command, so everything after it moves,
+    and with retarget also point a random VMJumpIf to another label of its script.
+    Returns the new lines and whether a jump was retargeted.
+    """
+    lines = list(lines)
+    start = lines.index("# commands")
+    # not right after a label, or the jumps to it would lead to the new command and be reported as well
+    commands = [l for l in range(start, len(lines))
+                if lines[l].startswith("    ") and not lines[l].startswith(("     ", "    _"))
+                and not lines[l - 1].lstrip().startswith("#")]
+    insert = rng.choice(commands)
+    # the code of the new command must stay reachable, so jumps to it are left alone
+    block = next(line.split()[1] for line in reversed(lines[:insert]) if line.lstrip().startswith("#"))
+    retargeted = False
+    jumps = [l for l in range(len(lines)) if lines[l].startswith("    VMJumpIf ") and lines[l].split()[-1] != block]
+    if retarget and len(jumps) > 0:
+        l = rng.choice(jumps)
+        label = lines[l].split()[-1]
+        script = label.partition("-")[0]
+        others = [line.split()[1] for line in lines
+                  if line.lstrip().startswith(f"# {script}-") and line.split()[1] != label]
+        if len(others) > 0:
+            lines[l] = f"{lines[l].rpartition(' ')[0]} {rng.choice(others)}"
+            retargeted = True
+    lines.insert(insert, DIFF_INSERT)
+    return lines, retargeted
+
+
+def bench_diff(files: int, changed: float, seed: int) -> dict:
+    """
+    Diff a generated bank of files against a copy where a share of the files was edited by edit_asm, half of them
+    with a retargeted jump, and check that the diff reports exactly the edits.
+    """
+    rng = random.Random(seed)
+    tables = get_opcode_tables()
+    old = []
+    new = []
+    # whether a jump was retargeted, by edited file
+    edits: dict[int, bool] = {}
+    for i in range(files):
+        lines = generate_asm(rng, tables, rng.randrange(1, 8), rng.randrange(10, 100), rng.choice((0.05, 0.25)),
+                             rng.randrange(16))
+        data = bytes(script_editing.assemble_lines(lines, tables))
+        old.append(data)
+        if rng.random() < changed:
+            # generated code can overlap and end up as raw bytes, the disassembly only has commands where the diff
+            # looks for them
+            lines = script_editing.disassemble_bytes(data, tables).splitlines()
+            lines, edits[i] = edit_asm(rng, lines, rng.random() < 0.5)
+            data = bytes(script_editing.assemble_lines(lines, tables))
+        new.append(data)
+    start = time.perf_counter()
+    diffs = [script_diff.diff_bytes(old_data, new_data, tables) for old_data, new_data in zip(old, new)]
+    seconds = time.perf_counter() - start
+
+    missed_insertions = 0
+    found_retargets = 0
+    unexpected_changes = 0
+    for i, file_diffs in enumerate(diffs):
+        changes = [change for diff in file_diffs for change in diff.changes]
+        if i not in edits:
+            unexpected_changes += len(changes)
+            continue
+        if not any(change.change == "added" and change.new == DIFF_INSERT for change in changes):
+            missed_insertions += 1
+        if edits[i]:
+            # moving the jump can also leave code unreachable, which is reported as removed
+            if any(change.change == "modified" and change.old.split()[0] == change.new.split()[0] == "VMJumpIf"
+                   for change in changes):
+                found_retargets += 1
+        else:
+            unexpected_changes += sum(1 for change in changes
+                                      if change.change != "added" or change.new != DIFF_INSERT)
+    return {
+        "files": files,
+        "edited_files": len(edits),
+        "retargeted_files": sum(edits.values()),
+        "seconds": seconds,
+        "missed_insertions": missed_insertions,
+        "found_retargets": found_retargets,
+        "unexpected_changes": unexpected_changes,
+    }
+
+
+def diff_ok(result: dict) -> bool:
+    return result["missed_insertions"] == 0 and result["unexpected_changes"] == 0 \
+        and result["found_retargets"] == result["retargeted_files"]
+
+
+def bench_stress(sizes: list[int], repeat: int, seed: int) -> dict:
+    """
+    Time the structure analysis of pathological files of growing size. growth is the time per byte of the largest
+    file divided by the time per byte of the smallest one, about 1 as long as the analysis is linear.
+    """
+    rng = random.Random(seed)
+    tables = get_opcode_tables()
+    results = {}
+    for kind in STRESS_KINDS:
+        rows = []
+        for size in sizes:
+            data = generate_pathological(rng, kind, size)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                script_editing.analyze(data, tables)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            rows.append({"bytes": len(data), "seconds": best, "us_per_byte": best / len(data) * 1e6})
+        results[kind] = {"sizes": rows, "growth": rows[-1]["us_per_byte"] / rows[0]["us_per_byte"]}
+    return results
+
+
+def bench_corpus(files: list[bytes], repeat: int) -> dict:
+    """
+    Disassemble and reassemble every file, returning the best time of each phase over all repeats,
+    the throughput and the peak memory of one pass.
+    """
+    phases: dict[str, float] = {}
+    best: dict[str, float] = {}
+
+    def record(name: str, seconds: float):
+        phases[name] = phases.get(name, 0.0) + seconds
+
+    size = sum(len(data) for data in files)
+    texts = [script_editing.disassemble_bytes(data).splitlines() for data in files]
+    lines = sum(len(text) for text in texts)
+    script_editing.phase_hook = record
+    try:
+        for _ in range(repeat):
+            phases.clear()
+            # cold table load, as a new process would do it
+            script_editing._loaded_tables.clear()
+            start = time.perf_counter()
+            get_opcode_tables()
+            record("tables", time.perf_counter() - start)
+            tables = get_opcode_tables()
+            start = time.perf_counter()
+            for data in files:
+                script_editing.disassemble_bytes(data, tables)
+            record("disassemble", time.perf_counter() - start)
+            start = time.perf_counter()
+            for text in texts:
+                script_editing.assemble_lines(text, tables)
+            record("assemble", time.perf_counter() - start)
+            for name, seconds in phases.items():
+                best[name] = min(seconds, best.get(name, seconds))
+    finally:
+        script_editing.phase_hook = None
+
+    tracemalloc.start()
+    for data, text in zip(files, texts):
+        script_editing.disassemble_bytes(data)
+        script_editing.assemble_lines(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "files": len(files),
+        "bytes": size,
+        "lines": lines,
+        "phases": {name: best.get(name, 0.0) for name in (*DISASSEMBLY_PHASES, *ASSEMBLY_PHASES)},
+        "disassemble_seconds": best["disassemble"],
+        "assemble_seconds": best["assemble"],
+        "disassemble_bytes_per_second": size / best["disassemble"] if best["disassemble"] > 0 else 0.0,
+        "assemble_bytes_per_second": size / best["assemble"] if best["assemble"] > 0 else 0.0,
+        "peak_memory": peak,
+    }
+
+
+def print_results(results: dict, baseline: dict | None = None):
+    for name, result in results["corpora"].items():
+        print(f"{name}: {result['files']} files, {result['bytes']} bytes, {result['lines']} lines, "
+              f"peak memory {result['peak_memory'] / 1024:.0f} KiB")
+        old = baseline["corpora"].get(name) if baseline is not None else None
+        rows = [(phase, result["phases"][phase], old["phases"].get(phase) if old else None)
+                for phase in result["phases"]]
+        rows += [(total, result[f"{total}_seconds"], old.get(f"{total}_seconds") if old else None)
+                 for total in ("disassemble", "assemble")]
+        for phase, seconds, old_seconds in rows:
+            line = f"    {phase:<12} {seconds * 1000:10.2f} ms"
+            if old_seconds:
+                line += f"  (was {old_seconds * 1000:.2f} ms, {old_seconds / seconds if seconds else 0:.2f}x)"
+            print(line)
+        print(f"    {result['disassemble_bytes_per_second'] / 1e6:.2f} MB/s disassembly, "
+              f"{result['assemble_bytes_per_second'] / 1e6:.2f} MB/s assembly")
+
+
+def print_stress(stress: dict):
+    for kind, result in stress.items():
+        times = ", ".join(f"{row['bytes']} bytes {row['seconds'] * 1000:.1f} ms" for row in result["sizes"])
+        verdict = "linear" if result["growth"] <= STRESS_LIMIT else "NOT LINEAR"
+        print(f"stress-{kind}: {times}, {result['growth']:.2f}x time per byte ({verdict})")
+
+
+def print_diff(result: dict):
+    print(f"diff: {result['files']} files, {result['edited_files']} edited, {result['seconds'] * 1000:.1f} ms, "
+          f"{result['missed_insertions']} missed insertions, {result['found_retargets']} of "
+          f"{result['retargeted_files']} retargeted jumps found, {result['unexpected_changes']} unexpected changes "
+          f"({'ok' if diff_ok(result) else 'WRONG'})")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark disassembly and assembly, phase by phase.")
+    parser.add_argument("corpus", nargs="*", help="script files, directories or glob patterns to benchmark")
+    parser.add_argument("--sizes", default="50,200,1000",
+                        help="commands per script of the synthetic corpora, empty for none")
+    parser.add_argument("--densities", default="0.05,0.25", help="branch densities of the synthetic corpora")
+    parser.add_argument("--files", type=int, default=20, help="files per synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic corpora")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per corpus, the best one counts")
+    parser.add_argument("-o", "--output", default=None, help="write the results to this json file")
+    parser.add_argument("--compare", default=None, help="json file of an earlier run to compare with")
+    parser.add_argument("--stress", action="store_true",
+                        help="also check that the analysis of pathological files stays linear in their size")
+    parser.add_argument("--stress-sizes", default="4000,16000,64000", help="sizes of the pathological files")
+    parser.add_argument("--diff", action="store_true",
+                        help="also diff a generated bank against an edited copy, and check what the diff reports")
+    parser.add_argument("--diff-files", type=int, default=880, help="files of the generated bank")
+    parser.add_argument("--diff-edited", type=float, default=0.1, help="share of the files that are edited")
+    args = parser.parse_args(argv)
+
+    tables = get_opcode_tables()
+    corpora: dict[str, list[bytes]] = {}
+    if len(args.corpus) > 0:
+        corpora["corpus"] = [script_editing.get_file_as_bytes(f)
+                             for f in script_editing.expand_inputs(args.corpus)]
+    if args.sizes:
+        corpora.update(generate_corpus(args.seed, [int(size) for size in args.sizes.split(",")],
+                                       [float(density) for density in args.densities.split(",")],
+                                       args.files, tables))
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "corpora": {name: bench_corpus(files, args.repeat) for name, files in corpora.items()},
+    }
+    if args.stress:
+        results["stress"] = bench_stress([int(size) for size in args.stress_sizes.split(",")], args.repeat, args.seed)
+    if args.diff:
+        results["diff"] = bench_diff(args.diff_files, args.diff_edited, args.seed)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "rt") as infile:
+            baseline = json.load(infile)
+    print_results(results, baseline)
+    if args.stress:
+        print_stress(results["stress"])
+    if args.diff:
+        print_diff(results["diff"])
+    if args.output is not None:
+        with open(args.output, "wt") as out:
+            json.dump(results, out, indent=2)
+    if args.stress and any(result["growth"] > STRESS_LIMIT for result in results["stress"].values()):
+        return 1
+    if args.diff and not diff_ok(results["diff"]):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
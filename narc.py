@@ -0,0 +1,123 @@
+
+import mmap
+import struct
+from os import PathLike
+
+
+NARC_HEADER = struct.Struct("<4sHHIHH")
+SECTION_HEADER = struct.Struct("<4sI")
+BTAF_COUNT = struct.Struct("<HH")
+BTAF_ENTRY = struct.Struct("<II")
+# name table of an archive without file names
+EMPTY_NAME_TABLE = b"\x04\x00\x00\x00\x00\x00\x01\x00"
+
+
+class Narc:
+    """
+    A NARC archive (like the one the 7_xxx script files come from), read through a memory map.
+    Every member is a memoryview into the mapped file, so nothing is copied until a member is changed.
+    Use it as a context manager, or call close() once the members are no longer used.
+    """
+
+    def __init__(self, f: PathLike | str):
+        self._file = open(f, "rb")
+        self._map = None
+        try:
+            # mmap fails on an empty file and unpack_from on a truncated one
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self._map)
+            self._parse(f)
+        except (ValueError, struct.error):
+            self.close()
+            raise Exception(f"Not a NARC archive: {f}")
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self, f: PathLike | str):
+        magic, bom, version, size, header_size, sections = NARC_HEADER.unpack_from(self.data, 0)
+        if magic != b"NARC" or bom != 0xfffe:
+            raise Exception(f"Not a NARC archive: {f}")
+        self.version = version
+        pointer = header_size
+        fat = None
+        self.name_table = EMPTY_NAME_TABLE
+        gmif = None
+        for _ in range(sections):
+            magic, section_size = SECTION_HEADER.unpack_from(self.data, pointer)
+            match magic:
+                case b"BTAF":
+                    count, _ = BTAF_COUNT.unpack_from(self.data, pointer + 8)
+                    fat = [BTAF_ENTRY.unpack_from(self.data, pointer + 12 + 8 * i) for i in range(count)]
+                case b"BTNF":
+                    self.name_table = bytes(self.data[pointer + 8:pointer + section_size])
+                case b"GMIF":
+                    gmif = pointer + 8
+            pointer += section_size
+        if fat is None or gmif is None:
+            raise Exception(f"Missing BTAF or GMIF section: {f}")
+        self.members: list[memoryview] = [self.data[gmif + start:gmif + end] for start, end in fat]
+        # byte used to align members to 4 bytes, taken from the first gap between two members
+        self.padding = 0xff
+        for (start, end), (next_start, _) in zip(fat, fat[1:]):
+            if next_start > end:
+                self.padding = self.data[gmif + end]
+                break
+
+    def close(self):
+        if self._file is None:
+            return
+        if hasattr(self, "members"):
+            for member in self.members:
+                member.release()
+        if hasattr(self, "data"):
+            self.data.release()
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+        self._file = None
+        self._map = None
+
+    def __enter__(self) -> "Narc":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+
+def build_narc(members: list[bytes | memoryview], name_table: bytes = EMPTY_NAME_TABLE, padding: int = 0xff,
+               version: int = 0x100) -> list[bytes | memoryview]:
+    """
+    Lay out a NARC archive, returning its parts in file order so they can be written sequentially
+    without joining the members into one buffer first.
+    """
+    fat = bytearray()
+    parts: list[bytes | memoryview] = []
+    offset = 0
+    for member in members:
+        if offset % 4 != 0:
+            parts.append(bytes((padding,)) * (4 - offset % 4))
+            offset += 4 - offset % 4
+        fat += BTAF_ENTRY.pack(offset, offset + len(member))
+        parts.append(member)
+        offset += len(member)
+    if offset % 4 != 0:
+        parts.append(bytes((padding,)) * (4 - offset % 4))
+        offset += 4 - offset % 4
+    if len(name_table) % 4 != 0:
+        name_table += bytes((padding,)) * (4 - len(name_table) % 4)
+    btaf = SECTION_HEADER.pack(b"BTAF", 12 + len(fat)) + BTAF_COUNT.pack(len(members), 0) + fat
+    btnf = SECTION_HEADER.pack(b"BTNF", 8 + len(name_table)) + name_table
+    gmif = SECTION_HEADER.pack(b"GMIF", 8 + offset)
+    size = NARC_HEADER.size + len(btaf) + len(btnf) + len(gmif) + offset
+    header = NARC_HEADER.pack(b"NARC", 0xfffe, version, size, NARC_HEADER.size, 3)
+    return [header, btaf, btnf, gmif, *parts]
+
+
+def write_narc(f: PathLike | str, members: list[bytes | memoryview], name_table: bytes = EMPTY_NAME_TABLE,
+               padding: int = 0xff, version: int = 0x100):
+    with open(f, "wb") as out:
+        out.writelines(build_narc(members, name_table, padding, version))
@@ -0,0 +1,144 @@
+
+import hashlib
+import os
+import shutil
+from os import PathLike
+from pathlib import Path
+
+
+class ResultCache:
+    """
+    Directory of (dis)assembly results, keyed by a hash of the input bytes and of salt.
+    The salt has to change whenever the same input could give a different result, like a new tool version
+    or different opcode tables. Entries are plain files named by their key, so a hit is one hash and one copy.
+    Once the cache grows past max_bytes, the least recently used entries are deleted.
+    Several processes can share the same directory.
+    """
+
+    def __init__(self, directory: PathLike | str, max_bytes: int = 512 * 1024 * 1024, salt: bytes = b""):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.salt = salt
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        # only an estimate with several processes, the real size is taken again before evicting
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def key(self, kind: str, data: bytes | memoryview) -> str:
+        """
+        Key of the result of kind ("asm", "bin" or "ok" for a successful round trip) for the input data.
+        """
+        h = hashlib.sha1(self.salt)
+        h.update(kind.encode())
+        h.update(data)
+        return h.hexdigest()
+
+    def path(self, key: str, kind: str) -> Path:
+        return self.directory / key[:2] / f"{key}.{kind}"
+
+    def get(self, key: str, kind: str) -> bytes | None:
+        path = self.path(key, kind)
+        try:
+            with open(path, "rb") as infile:
+                data = infile.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self._touch(path)
+        self.hits += 1
+        return data
+
+    def copy_to(self, key: str, kind: str, dest: PathLike | str) -> bool:
+        """
+        Copy a cached result to dest, returning False if there is none.
+        """
+        path = self.path(key, kind)
+        try:
+            shutil.copyfile(path, dest)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self._touch(path)
+        self.hits += 1
+        return True
+
+    def put(self, key: str, kind: str, data: bytes | bytearray):
+        path = self.path(key, kind)
+        tmp = self._tmp_path(path)
+        with open(tmp, "wb") as out:
+            out.write(data)
+        self._commit(tmp, path, len(data))
+
+    def put_file(self, key: str, kind: str, src: PathLike | str):
+        """
+        Store a copy of the result file src.
+        """
+        path = self.path(key, kind)
+        tmp = self._tmp_path(path)
+        shutil.copyfile(src, tmp)
+        self._commit(tmp, path, os.path.getsize(tmp))
+
+    def _tmp_path(self, path: Path) -> Path:
+        os.makedirs(path.parent, exist_ok=True)
+        return path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+    def _commit(self, tmp: Path, path: Path, size: int):
+        # replacing is atomic, so other processes never see a half written entry
+        os.replace(tmp, path)
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def _touch(self, path: Path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            pass
+
+    def _entries(self) -> list[tuple[int, int, Path]]:
+        """
+        (modification time, size, path) of every entry. The modification time is the time of the last use.
+        """
+        entries = []
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, Path(entry.path)))
+        return entries
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is down to three quarters of max_bytes,
+        so a full cache is not scanned again on every new entry.
+        """
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
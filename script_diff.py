@@ -0,0 +1,397 @@
+
+import argparse
+import hashlib
+import json
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from difflib import SequenceMatcher
+from os import PathLike
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import narc
+import script_editing
+from script_editing import (U32, BasicBlock, FlowKind, Instruction, OpcodeTables, analyze, format_command,
+                            get_opcode_tables, read_u16)
+
+
+# stands in for jump targets outside of the block in the block hashes
+OUTSIDE_BLOCK = U32.pack(0xffffffff)
+# (address, is_action) of an instruction
+InstructionKey = tuple[int, bool]
+# (instruction, key, is_action) of the instruction diff of unmatched blocks
+DiffItem = tuple[Instruction, bytes, bool]
+
+
+class DiffBlock(NamedTuple):
+    block: BasicBlock
+    # the bytes of every instruction, with a jump target replaced by its offset from the start of the block
+    # if it points into the block and by OUTSIDE_BLOCK otherwise, so moving code around does not change them
+    keys: list[bytes]
+    digest: bytes
+
+    @property
+    def addr(self) -> int:
+        return self.block.addr
+
+    @property
+    def is_action(self) -> bool:
+        return self.block.is_action
+
+    @property
+    def instructions(self) -> list[Instruction]:
+        return self.block.instructions
+
+
+class InstructionChange(NamedTuple):
+    # "added", "removed" or "modified"
+    change: str
+    old_addr: int | None
+    new_addr: int | None
+    # .asm lines, with the labels of the full disassembly of each version
+    old: str | None
+    new: str | None
+
+
+class ScriptDiff(NamedTuple):
+    script: int
+    # "modified", "added" or "removed"
+    status: str
+    # number of "unchanged", "modified", "added" and "removed" blocks
+    blocks: dict[str, int]
+    changes: list[InstructionChange]
+
+
+def hash_block(data: bytes, block: BasicBlock) -> DiffBlock:
+    last = block.instructions[-1]
+    end = last.addr + (4 if block.is_action else last.op.length)
+    keys = []
+    for instruction in block.instructions:
+        if block.is_action:
+            keys.append(data[instruction.addr:instruction.addr+4])
+            continue
+        op = instruction.op
+        if op.target_offset is None:
+            keys.append(data[instruction.addr:instruction.addr+op.length])
+            continue
+        target = OUTSIDE_BLOCK
+        if block.addr <= instruction.target < end:
+            target = U32.pack(instruction.target - block.addr)
+        keys.append(data[instruction.addr:instruction.addr+op.target_offset] + target
+                    + data[instruction.addr+op.target_offset+4:instruction.addr+op.length])
+    digest = hashlib.sha1(bytes((block.is_action,)) + b"".join(keys), usedforsecurity=False).digest()
+    return DiffBlock(block, keys, digest)
+
+
+class FileBlocks:
+    """
+    The basic blocks of a file (see ControlFlowWalker.basic_blocks), hashed independently of where they are.
+    Blocks are split at every label of the whole file, so a subroutine shared by several scripts is the same
+    block in each of them and is only hashed once. Like in the disassembly, instructions that overlap with
+    other code are raw bytes, and are not part of any block.
+    """
+
+    def __init__(self, data: bytes, tables: OpcodeTables | None = None):
+        self.data = data
+        self.scripts, self.walker = analyze(data, tables)
+        self.blocks = {addr: hash_block(data, block) for addr, block in self.walker.basic_blocks().items()}
+
+    def __len__(self) -> int:
+        return len(self.scripts)
+
+    def script_blocks(self, index: int) -> list[DiffBlock]:
+        """
+        Every block reachable from a script entry, in address order.
+        """
+        worklist = [self.scripts[index]]
+        seen = set(worklist)
+        blocks = []
+        while worklist:
+            addr = worklist.pop()
+            if addr not in self.blocks:
+                continue
+            block = self.blocks[addr]
+            blocks.append(block)
+            for _, successor in block.block.successors:
+                if successor not in seen:
+                    seen.add(successor)
+                    worklist.append(successor)
+        blocks.sort(key=lambda block: block.addr)
+        return blocks
+
+    def line(self, instruction: Instruction, is_action: bool) -> str:
+        if not is_action:
+            return format_command(instruction.op, self.data, instruction.addr, self.walker.links)
+        value = read_u16(self.data, instruction.addr + 2)
+        name = instruction.op.name if instruction.op is not None else hex(instruction.code)
+        return f"     {name} {value}"
+
+
+def flatten(blocks: list[DiffBlock]) -> list[DiffItem]:
+    return [(instruction, key, block.is_action) for block in blocks
+            for instruction, key in zip(block.instructions, block.keys)]
+
+
+def retargeted(old_instruction: Instruction, new_instruction: Instruction, moved: dict[InstructionKey, int],
+               matched: set[InstructionKey]) -> bool:
+    """
+    Whether two instructions with the same bytes apart from their target jump to code that does not correspond.
+    If the old target was not matched, the jump only counts as changed when the new target was matched to
+    some other old instruction, otherwise it is left to the diff of the code there.
+    """
+    if old_instruction.target is None:
+        return False
+    is_action = old_instruction.op.flow == FlowKind.ACTOR_EXEC
+    if (old_instruction.target, is_action) in moved:
+        return moved[(old_instruction.target, is_action)] != new_instruction.target
+    return (new_instruction.target, is_action) in matched
+
+
+class Segment(NamedTuple):
+    # opcode of the block diff, "equal", "replace", "insert" or "delete"
+    tag: str
+    old_blocks: list[DiffBlock]
+    new_blocks: list[DiffBlock]
+    # opcodes of the instruction diff of blocks that did not match, over flatten() of the blocks
+    opcodes: list[tuple[str, int, int, int, int]]
+
+
+def diff_instructions(old_blocks: list[DiffBlock],
+                      new_blocks: list[DiffBlock]) -> list[tuple[str, int, int, int, int]]:
+    """
+    The opcodes of the instruction diff over flatten() of two runs of blocks. Blocks that start the same are paired
+    first and diffed on their own, so an instruction is not matched into another block just because it comes first.
+    """
+    pieces = []
+    heads = SequenceMatcher(None, [(block.is_action, block.keys[0]) for block in old_blocks],
+                            [(block.is_action, block.keys[0]) for block in new_blocks], autojunk=False)
+    for tag, i1, i2, j1, j2 in heads.get_opcodes():
+        if tag == "equal":
+            pieces.extend((old_blocks[i:i+1], new_blocks[j:j+1]) for i, j in zip(range(i1, i2), range(j1, j2)))
+        else:
+            pieces.append((old_blocks[i1:i2], new_blocks[j1:j2]))
+    opcodes = []
+    old_start = 0
+    new_start = 0
+    for old_piece, new_piece in pieces:
+        old_keys = [key for block in old_piece for key in block.keys]
+        new_keys = [key for block in new_piece for key in block.keys]
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_keys, new_keys, autojunk=False).get_opcodes():
+            opcodes.append((tag, old_start + i1, old_start + i2, new_start + j1, new_start + j2))
+        old_start += len(old_keys)
+        new_start += len(new_keys)
+    return opcodes
+
+
+def align_script(old_blocks: list[DiffBlock], new_blocks: list[DiffBlock],
+                 moved: dict[InstructionKey, int]) -> list[Segment]:
+    """
+    Match the blocks of two versions of a script by hash in address order, then the instructions of the blocks
+    in between by their bytes (see diff_instructions). Every matched instruction is recorded in moved.
+    """
+    old_digests = [block.digest for block in old_blocks]
+    new_digests = [block.digest for block in new_blocks]
+    if old_digests == new_digests:
+        block_opcodes = [("equal", 0, len(old_blocks), 0, len(new_blocks))]
+    else:
+        block_opcodes = SequenceMatcher(None, old_digests, new_digests, autojunk=False).get_opcodes()
+    segments = []
+    for tag, i1, i2, j1, j2 in block_opcodes:
+        if tag == "equal":
+            for old_block, new_block in zip(old_blocks[i1:i2], new_blocks[j1:j2]):
+                for old_instruction, new_instruction in zip(old_block.instructions, new_block.instructions):
+                    moved.setdefault((old_instruction.addr, old_block.is_action), new_instruction.addr)
+            segments.append(Segment(tag, old_blocks[i1:i2], new_blocks[j1:j2], []))
+            continue
+        old_items = flatten(old_blocks[i1:i2])
+        new_items = flatten(new_blocks[j1:j2])
+        opcodes = diff_instructions(old_blocks[i1:i2], new_blocks[j1:j2])
+        for item_tag, k1, k2, l1, l2 in opcodes:
+            if item_tag == "equal":
+                for (old_instruction, _, is_action), (new_instruction, _, _) \
+                        in zip(old_items[k1:k2], new_items[l1:l2]):
+                    moved.setdefault((old_instruction.addr, is_action), new_instruction.addr)
+        segments.append(Segment(tag, old_blocks[i1:i2], new_blocks[j1:j2], opcodes))
+    return segments
+
+
+def diff_segments(old: FileBlocks, new: FileBlocks, segments: list[Segment], moved: dict[InstructionKey, int],
+                  matched: set[InstructionKey]) -> tuple[dict[str, int], list[InstructionChange]]:
+    """
+    Count the changed blocks of an aligned script and list its changed instructions.
+    matched holds the new instructions in moved.
+    """
+    counts = {"unchanged": 0, "modified": 0, "added": 0, "removed": 0}
+    changes: list[InstructionChange] = []
+
+    def modified(old_item: DiffItem, new_item: DiffItem):
+        changes.append(InstructionChange("modified", old_item[0].addr, new_item[0].addr,
+                                         old.line(old_item[0], old_item[2]), new.line(new_item[0], new_item[2])))
+
+    for segment in segments:
+        if segment.tag == "equal":
+            for old_block, new_block in zip(segment.old_blocks, segment.new_blocks):
+                last = len(changes)
+                for old_item, new_item in zip(flatten([old_block]), flatten([new_block])):
+                    if retargeted(old_item[0], new_item[0], moved, matched):
+                        modified(old_item, new_item)
+                counts["unchanged" if len(changes) == last else "modified"] += 1
+            continue
+        paired = min(len(segment.old_blocks), len(segment.new_blocks))
+        counts["modified"] += paired
+        counts["removed"] += len(segment.old_blocks) - paired
+        counts["added"] += len(segment.new_blocks) - paired
+        old_items = flatten(segment.old_blocks)
+        new_items = flatten(segment.new_blocks)
+        for tag, i1, i2, j1, j2 in segment.opcodes:
+            if tag == "equal":
+                for old_item, new_item in zip(old_items[i1:i2], new_items[j1:j2]):
+                    if retargeted(old_item[0], new_item[0], moved, matched):
+                        modified(old_item, new_item)
+                continue
+            paired = min(i2 - i1, j2 - j1)
+            for old_item, new_item in zip(old_items[i1:i1+paired], new_items[j1:j1+paired]):
+                modified(old_item, new_item)
+            for instruction, _, is_action in old_items[i1+paired:i2]:
+                changes.append(InstructionChange("removed", instruction.addr, None,
+                                                 old.line(instruction, is_action), None))
+            for instruction, _, is_action in new_items[j1+paired:j2]:
+                changes.append(InstructionChange("added", None, instruction.addr, None,
+                                                 new.line(instruction, is_action)))
+    return counts, changes
+
+
+def diff_bytes(old_data: bytes, new_data: bytes, tables: OpcodeTables | None = None) -> list[ScriptDiff]:
+    """
+    Compare two versions of a script file, returning the scripts that changed.
+    Scripts are matched by their index in the script table, and the blocks of a script by their hash in
+    address order, so code that only moved is not reported. Only the blocks between matches are diffed
+    instruction by instruction. A jump is reported as changed when it leads to code that does not correspond
+    to its old target, even if the jump itself only moved.
+    """
+    if old_data == new_data:
+        return []
+    if tables is None:
+        tables = get_opcode_tables()
+    old = FileBlocks(old_data, tables)
+    new = FileBlocks(new_data, tables)
+    diffs: list[ScriptDiff] = []
+    aligned: list[tuple[int, list[Segment]]] = []
+    # new address of every old instruction matched in any script, to check where jumps lead
+    moved: dict[InstructionKey, int] = {}
+    for index in range(max(len(old), len(new))):
+        if index >= len(new):
+            diffs.append(ScriptDiff(index, "removed", {}, []))
+            continue
+        if index >= len(old):
+            diffs.append(ScriptDiff(index, "added", {}, []))
+            continue
+        aligned.append((index, align_script(old.script_blocks(index), new.script_blocks(index), moved)))
+    # jumps can only be checked once the code of every script was matched
+    matched = {(addr, is_action) for (_, is_action), addr in moved.items()}
+    for index, segments in aligned:
+        counts, changes = diff_segments(old, new, segments, moved, matched)
+        if changes:
+            diffs.append(ScriptDiff(index, "modified", counts, changes))
+    diffs.sort(key=lambda diff: diff.script)
+    return diffs
+
+
+def is_narc(f: PathLike | str) -> bool:
+    with open(f, "rb") as infile:
+        return infile.read(4) == b"NARC"
+
+
+@contextmanager
+def open_bank(f: PathLike | str) -> Iterator[dict[str, bytes | memoryview]]:
+    """
+    The script files of a bank by name: the relative path of every file of a directory, the member number
+    of every member of a NARC archive, or just the file name of a single script file.
+    """
+    path = Path(f)
+    if path.is_dir():
+        yield {file.relative_to(path).as_posix(): script_editing.get_file_as_bytes(file)
+               for file in sorted(path.rglob("*")) if file.is_file()}
+    elif is_narc(path):
+        with narc.Narc(path) as container:
+            yield {str(member): container.members[member] for member in range(len(container))}
+    else:
+        yield {path.name: script_editing.get_file_as_bytes(path)}
+
+
+def diff_banks(old: PathLike | str, new: PathLike | str, tables: OpcodeTables | None = None) -> Iterator[dict]:
+    """
+    Compare two script banks (directories, NARC archives or single files), yielding a json serializable dict
+    for every changed script and for every file that only exists in one of them, or where only bytes outside
+    of the code changed. Identical files are skipped without being walked.
+    """
+    if tables is None:
+        tables = get_opcode_tables()
+    with ExitStack() as stack:
+        banks = []
+        for bank in (old, new):
+            try:
+                banks.append(stack.enter_context(open_bank(bank)))
+            except Exception as e:
+                # like a truncated archive or a missing path
+                yield {"file": str(bank), "script": None, "status": "error", "error": repr(e.args)}
+        if len(banks) < 2:
+            return
+        old_files, new_files = banks
+        if Path(old).is_file() and Path(new).is_file() and not is_narc(old) and not is_narc(new):
+            # two single files are compared even if their names differ
+            new_files = dict(zip(old_files, new_files.values()))
+        # shorter names first, so archive members come in numeric order
+        for name in sorted(old_files.keys() | new_files.keys(), key=lambda name: (len(name), name)):
+            if name not in new_files:
+                yield {"file": name, "script": None, "status": "removed"}
+                continue
+            if name not in old_files:
+                yield {"file": name, "script": None, "status": "added"}
+                continue
+            old_data = old_files[name]
+            new_data = new_files[name]
+            if old_data == new_data:
+                continue
+            try:
+                diffs = diff_bytes(bytes(old_data), bytes(new_data), tables)
+            except Exception as e:
+                yield {"file": name, "script": None, "status": "error", "error": repr(e.args)}
+                continue
+            if len(diffs) == 0:
+                # only bytes outside of the code changed, like raw data or overlapping instructions
+                yield {"file": name, "script": None, "status": "data"}
+            for diff in diffs:
+                result = {"file": name, **diff._asdict()}
+                result["changes"] = [change._asdict() for change in diff.changes]
+                yield result
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Instruction level diff of two script files or banks, that"
+                                                 " ignores code that only moved.")
+    parser.add_argument("old", help="script file, directory of script files or NARC archive")
+    parser.add_argument("new", help="script file, directory of script files or NARC archive")
+    parser.add_argument("--brief", action="store_true", help="only count the changed blocks of every script")
+    parser.add_argument("--table-cache", default=None, help="directory for pickled opcode tables")
+    args = parser.parse_args(argv)
+
+    script_editing.table_cache_dir = args.table_cache
+    start = time.perf_counter()
+    files = set()
+    scripts = 0
+    for result in diff_banks(args.old, args.new):
+        files.add(result["file"])
+        if result["script"] is not None:
+            scripts += 1
+        if args.brief:
+            result.pop("changes", None)
+        sys.stdout.write(json.dumps(result) + "\n")
+    print(f"{scripts} scripts in {len(files)} files changed, {(time.perf_counter() - start) * 1000:.1f} ms",
+          file=sys.stderr)
+    return 1 if files else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
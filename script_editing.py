@@ -1,6 +1,27 @@
 
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+import struct
+import sys
+import time
 from os import PathLike
-from enum import Enum
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from enum import Enum, IntEnum
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple, TextIO
+
+import narc
+from result_cache import ResultCache
+
+# part of the result cache key, bump it whenever the output for the same input changes
+__version__ = "1.1.0"
 
 
 def get_file_as_bytes(f: PathLike | str) -> bytes:
@@ -22,21 +43,228 @@ def get_text_file_lines(f: PathLike | str) -> list[str]:
 
 
 debug_active = False
+debug_hook: Callable[[str], None] = print
 print_disassembly = False
+# directory for pickled opcode tables, None to always parse commands.txt and actions.txt
+table_cache_dir: PathLike | str | None = None
+# cache of disassembly and assembly results, see open_result_cache
+result_cache: ResultCache | None = None
+
+
+def debug(s: str):
+    """
+    Print debug output through debug_hook if debug_active is set.
+    Hot paths check debug_active themselves, so their messages are not even formatted when debugging is off.
+    """
+    if not debug_active:
+        return
+    debug_hook(s)
+
+
+# called with (phase name, seconds) after each phase of disassembly and assembly, None to skip timing
+phase_hook: Callable[[str, float], None] | None = None
+
+
+@contextmanager
+def timed_phase(name: str):
+    if phase_hook is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_hook(name, time.perf_counter() - start)
+
+
+class FlowKind(Enum):
+    NONE = 0
+    HALT = 1
+    RETURN = 2
+    CALL = 3
+    JUMP = 4
+    JUMP_IF = 5
+    CALL_IF = 6
+    ACTOR_EXEC = 7
+
+
+# commands that change the control flow of a script, the rest just continue with the next command
+CONTROL_FLOW: dict[int, FlowKind] = {
+    0x2: FlowKind.HALT,  # VMHalt
+    0x4: FlowKind.CALL,  # VMCall
+    0x5: FlowKind.RETURN,  # VMReturn
+    0x1e: FlowKind.JUMP,  # VMJump
+    0x1f: FlowKind.JUMP_IF,  # VMJumpIf
+    0x20: FlowKind.CALL_IF,  # VMCallIf
+    0x64: FlowKind.ACTOR_EXEC,  # ActorCmdExec
+    0x8c: FlowKind.HALT,  # CallTrainerLose
+    0x17a: FlowKind.HALT,  # CallWildLose
+}
+END_ACTION = 0xfe
+
+
+# struct formats of the parameter widths in commands.txt
+WIDTH_FORMATS = {1: "B", 2: "H", 4: "I"}
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+# action code and value
+ACTION_FIELDS = struct.Struct("<HH")
+
+
+class Opcode(NamedTuple):
+    code: int
+    name: str
+    params: tuple[str, ...]
+    widths: tuple[int, ...]
+    # total length including the 2 opcode bytes
+    length: int
+    flow: FlowKind
+    # offset of the relative 4 byte jump target from the start of the command, if any
+    target_offset: int | None
+    # the whole command, opcode followed by its parameters
+    fields: struct.Struct
+
+
+def read_u16(data: bytes, addr: int) -> int:
+    if addr + 2 <= len(data):
+        return U16.unpack_from(data, addr)[0]
+    # like int.from_bytes, missing bytes at the end of the file count as zero
+    return int.from_bytes(data[addr:addr+2], "little")
+
+
+def unpack_command(op: Opcode, data: bytes, addr: int) -> tuple[int, ...]:
+    """
+    Decode the opcode and all parameters of the command at addr in one go, without slicing data.
+    """
+    if addr + op.length <= len(data):
+        return op.fields.unpack_from(data, addr)
+    values = [op.code]
+    pointer = addr + 2
+    for width in op.widths:
+        values.append(int.from_bytes(data[pointer:pointer+width], "little"))
+        pointer += width
+    return tuple(values)
+
+
+class OpcodeTable:
+    """
+    Definitions from commands.txt or actions.txt, indexed by opcode and by name.
+    """
+
+    def __init__(self, rows: list[tuple[int, str, tuple[str, ...]]], source_hash: str = ""):
+        self.rows = rows
+        self.source_hash = source_hash
+        self.by_code: dict[int, Opcode] = {}
+        self.by_name: dict[str, Opcode] = {}
+        for code, name, params in rows:
+            widths = tuple(int(par[0]) for par in params)
+            flow = CONTROL_FLOW.get(code, FlowKind.NONE)
+            target_offset = None
+            if flow in (FlowKind.CALL, FlowKind.JUMP, FlowKind.JUMP_IF, FlowKind.CALL_IF, FlowKind.ACTOR_EXEC):
+                target_offset = 2 + sum(widths[:-1])
+            fields = struct.Struct("<H" + "".join(WIDTH_FORMATS[width] for width in widths))
+            op = Opcode(code, name, params, widths, 2 + sum(widths), flow, target_offset, fields)
+            self.by_code[code] = op
+            self.by_name[name] = op
+            if debug_active:
+                debug(f"Registered {op}")
+
+    @classmethod
+    def parse(cls, text: str, source_hash: str = "") -> "OpcodeTable":
+        rows = []
+        for line in text.splitlines():
+            c = line.split()
+            if len(c) == 0:
+                continue
+            rows.append((int(c[0], 16), c[1], tuple(c[2:])))
+        return cls(rows, source_hash)
+
+    @classmethod
+    def load(cls, f: PathLike | str, cache_dir: PathLike | str | None = None) -> "OpcodeTable":
+        """
+        Parse a table file, optionally going through a pickle of the parsed rows in cache_dir.
+        The pickle is used as long as the modification time and size of the file are unchanged,
+        otherwise it is still used if the content hash matches, and rewritten if not.
+        """
+        if cache_dir is None:
+            text = get_text_file(f)
+            return cls.parse(text, hashlib.sha1(text.encode()).hexdigest())
+        stat = os.stat(f)
+        cache_file = Path(cache_dir, Path(f).name + ".pickle")
+        cached = None
+        try:
+            with open(cache_file, "rb") as infile:
+                cached = pickle.load(infile)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        if cached is not None and (cached["mtime"], cached["size"]) == (stat.st_mtime_ns, stat.st_size):
+            debug(f"Loaded {f} from {cache_file}")
+            return cls(cached["rows"], cached["hash"])
+        text = get_text_file(f)
+        source_hash = hashlib.sha1(text.encode()).hexdigest()
+        if cached is not None and cached["hash"] == source_hash:
+            table = cls(cached["rows"], source_hash)
+        else:
+            table = cls.parse(text, source_hash)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, "wb") as out:
+                pickle.dump({"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": source_hash,
+                             "rows": table.rows}, out)
+        except OSError:
+            pass
+        return table
+
+
+class OpcodeTables(NamedTuple):
+    commands: OpcodeTable
+    actions: OpcodeTable
+
+
+COMMANDS_FILE = Path(__file__).with_name("commands.txt")
+ACTIONS_FILE = Path(__file__).with_name("actions.txt")
+_loaded_tables: dict[tuple[str, str], tuple[tuple[int, int], OpcodeTables]] = {}
+
+
+def get_opcode_tables(commands_file: PathLike | str = COMMANDS_FILE, actions_file: PathLike | str = ACTIONS_FILE,
+                      cache_dir: PathLike | str | None = None) -> OpcodeTables:
+    """
+    Load commands.txt and actions.txt once per process.
+    They are only loaded again if one of the files was modified in the meantime.
+    """
+    if cache_dir is None:
+        cache_dir = table_cache_dir
+    key = (str(commands_file), str(actions_file))
+    stamp = (os.stat(commands_file).st_mtime_ns, os.stat(actions_file).st_mtime_ns)
+    if key in _loaded_tables and _loaded_tables[key][0] == stamp:
+        return _loaded_tables[key][1]
+    tables = OpcodeTables(OpcodeTable.load(commands_file, cache_dir), OpcodeTable.load(actions_file, cache_dir))
+    _loaded_tables[key] = (stamp, tables)
+    return tables
 
 
-def see_write(out, s, end="\n"):
-    if print_disassembly:
-        print(s, end=end)
-    print(s, end=end, file=out)
+def open_result_cache(directory: PathLike | str, max_bytes: int, tables: OpcodeTables | None = None) -> ResultCache:
+    """
+    Open a result cache whose keys also depend on the tool version and the opcode tables,
+    so results of an older version or of edited tables are never used.
+    """
+    if tables is None:
+        tables = get_opcode_tables()
+    salt = f"{__version__}\n{tables.commands.source_hash}\n{tables.actions.source_hash}\n".encode()
+    return ResultCache(directory, max_bytes, salt)
 
 
-def debug(s):
-    if debug_active:
-        print(s)
+class AddressError(Exception):
+    """
+    Error while analysing the command at a known address of a script file.
+    """
 
+    def __init__(self, *args, address: int):
+        super().__init__(*args)
+        self.address = address
 
-class ByteType(Enum):
+
+class ByteType(IntEnum):
     UNKNOWN = 0
     IGNORE = 1
     RAW = 2
@@ -46,299 +274,648 @@ class ByteType(Enum):
     ACTION_TAIL = 6
 
 
-def disassemble(f: PathLike | str, dest: PathLike | str):
-    data = get_file_as_bytes(f)
-    command_text = get_text_file_lines("commands.txt")
-    action_text = get_text_file_lines("actions.txt")
-    commands = {}
-    actions = {}
-    for line in command_text:
-        c = line.split()
-        commands[int(c[0], 16)] = c
-        debug(f"Registered command {c}")
-    for line in action_text:
-        a = line.split()
-        actions[int(a[0], 16)] = a
-        debug(f"Registered action {a}")
+# preallocated runs of every byte type, so tagging a command is a slice assignment without a new buffer
+TAG_RUN_SIZE = 64
+TAG_RUNS: dict[int, memoryview] = {t: memoryview(bytes((t,)) * TAG_RUN_SIZE) for t in ByteType}
+
+
+def tag_run(tag: ByteType, length: int) -> memoryview | bytes:
+    if length <= TAG_RUN_SIZE:
+        return TAG_RUNS[tag][:length]
+    return bytes((tag,)) * length
+
+
+# distance of every tail byte to the start of its instruction, commands are never longer than 255 bytes
+TAIL_OFFSETS = memoryview(bytes(range(256)))
+
+
+def read_script_table(data: bytes) -> list[int]:
+    """
+    Read the script pointer table at the start of a script file, which ends with the stop bytes 0x13 0xFD.
+    Returns the absolute address of each script.
+    """
     pointer = 0
     scripts = []
+    # the table ends at the first script at the latest, a set keeps that check constant time for long tables
+    script_set = set()
     while data[pointer:pointer+2] != b'\x13\xfd':
-        if pointer in scripts:
+        if pointer in script_set:
             break
-        scr_addr = 4 + pointer + int.from_bytes(data[pointer:pointer+4], "little")
+        scr_addr = 4 + pointer + (U32.unpack_from(data, pointer)[0] if pointer + 4 <= len(data)
+                                   else int.from_bytes(data[pointer:pointer+4], "little"))
         scripts.append(scr_addr)
+        script_set.add(scr_addr)
         pointer += 4
         debug(f"Registered script {pointer//4-1} with address {scr_addr}")
+    return scripts
+
+
+class Instruction(NamedTuple):
+    addr: int
+    code: int
+    # None for action codes missing in actions.txt
+    op: Opcode | None
+    # absolute address of the jump target, if any
+    target: int | None
+
+
+class BasicBlock(NamedTuple):
+    addr: int
+    is_action: bool
+    instructions: list[Instruction]
+    # (kind of the edge, address of the next block), FlowKind.NONE is the fall through to the next instruction
+    successors: list[tuple[FlowKind, int]]
+
 
-    # structure analysis
-    structure: list[ByteType] = [ByteType.UNKNOWN] * len(data)
-    links: dict[int, str] = {}
+class ControlFlowWalker:
+    """
+    Structure analysis of a script file.
+    Follows the control flow from every script entry, tagging each address with its ByteType and naming every
+    jump target in links. Conflicting (overlapping) instructions are turned into raw bytes.
+    Uses an explicit worklist instead of recursion, and visits branches in the same depth first order
+    as the recursive walker did, so labels get the same numbers.
+    """
 
-    def fill_raw_action(addr: int, shift: int):
-        debug(f"{'  '*shift}Filling raw action at {addr}")
+    def __init__(self, data: bytes, tables: OpcodeTables | None = None):
+        if tables is None:
+            tables = get_opcode_tables()
+        self.data = data
+        self.commands = tables.commands.by_code
+        self.actions = tables.actions.by_code
+        # one ByteType per address of data, all UNKNOWN (0) to begin with
+        self.structure = bytearray(len(data))
+        # for every COMMAND_TAIL and ACTION_TAIL byte, its distance to the start of the instruction,
+        # so overlapping instructions are found without scanning backwards
+        # (with room for a command that runs past the end of data)
+        self.tail_offsets = bytearray(len(data) + max(op.length for op in self.commands.values()))
+        # where walking from a raw command or action leads, see skip_raw
+        self.raw_command_skips: dict[int, int] = {}
+        self.raw_action_skips: dict[int, int] = {}
+        self.links: dict[int, str] = {}
+        # every command and action decoded so far, by address
+        self.decoded_commands: dict[int, Instruction] = {}
+        self.decoded_actions: dict[int, Instruction] = {}
+
+    def decode_command(self, addr: int) -> Instruction:
+        if addr in self.decoded_commands:
+            return self.decoded_commands[addr]
+        code = read_u16(self.data, addr)
+        op = self.commands[code]
+        target = None
+        if op.target_offset is not None:
+            # the jump target is always the last parameter
+            target = (addr + op.length + unpack_command(op, self.data, addr)[-1]) % 0x100000000
+        instruction = Instruction(addr, code, op, target)
+        self.decoded_commands[addr] = instruction
+        return instruction
+
+    def decode_action(self, addr: int) -> Instruction:
+        if addr in self.decoded_actions:
+            return self.decoded_actions[addr]
+        code = read_u16(self.data, addr)
+        instruction = Instruction(addr, code, self.actions.get(code), None)
+        self.decoded_actions[addr] = instruction
+        return instruction
+
+    def instruction_start(self, addr: int) -> int:
+        """
+        Start of the command or action that the COMMAND_TAIL or ACTION_TAIL byte at addr belongs to.
+        """
+        return addr - self.tail_offsets[addr]
+
+    def command_length(self, addr: int) -> int:
+        """
+        Length of the command tagged at addr, which was decoded before it was tagged.
+        """
+        return self.decoded_commands[addr].op.length
+
+    def fill_raw_action(self, addr: int, shift: int):
+        structure = self.structure
+        if debug_active:
+            debug(f"{'  '*shift}Filling raw action at {addr}")
         match structure[addr]:
             case ByteType.COMMAND_HEADER:
-                structure[addr : addr + 4] = [ByteType.RAW] * 4
-                down_command = int.from_bytes(data[addr:addr+2], "little")
-                down_params_len = sum(int(par[0]) for par in commands[down_command][2:])
-                structure[addr : addr + down_params_len + 2] = [ByteType.RAW] * (down_params_len+2)
+                structure[addr : addr + 4] = tag_run(ByteType.RAW, 4)
+                length = self.command_length(addr)
+                structure[addr : addr + length] = tag_run(ByteType.RAW, length)
             case ByteType.COMMAND_TAIL:
-                down_addr = addr - 1
-                while structure[down_addr] == ByteType.COMMAND_TAIL:
-                    down_addr -= 1
-                down_command = int.from_bytes(data[down_addr:down_addr+2], "little")
-                down_params_len = sum(int(par[0]) for par in commands[down_command][2:])
-                structure[down_addr : down_addr + down_params_len + 2] = [ByteType.RAW] * (down_params_len+2)
+                down_addr = self.instruction_start(addr)
+                length = self.command_length(down_addr)
+                structure[down_addr : down_addr + length] = tag_run(ByteType.RAW, length)
             case ByteType.ACTION_TAIL:
-                down_addr = addr - 1
-                while structure[down_addr] == ByteType.ACTION_TAIL:
-                    down_addr -= 1
-                structure[down_addr : down_addr + 4] = [ByteType.RAW] * 4
+                down_addr = self.instruction_start(addr)
+                structure[down_addr : down_addr + 4] = tag_run(ByteType.RAW, 4)
         structure[addr] = ByteType.RAW
-        for next_addr in range(1, 4):
+        # an action cut off by the end of the file only covers the bytes that are there
+        for next_addr in range(addr+1, min(addr+4, len(structure))):
             match structure[next_addr]:
                 case ByteType.COMMAND_HEADER:
-                    down_command = int.from_bytes(data[next_addr:next_addr+2], "little")
-                    down_params_len = sum(int(par[0]) for par in commands[down_command][2:])
-                    structure[next_addr : next_addr + down_params_len + 2] = [ByteType.RAW] * (down_params_len+2)
+                    length = self.command_length(next_addr)
+                    structure[next_addr : next_addr + length] = tag_run(ByteType.RAW, length)
                 case ByteType.ACTION_HEADER:
-                    structure[next_addr: next_addr + 4] = [ByteType.RAW] * 4
+                    structure[next_addr: next_addr + 4] = tag_run(ByteType.RAW, 4)
             structure[next_addr] = ByteType.RAW
 
-    def fill_raw_command(addr: int, params_len: int, shift: int):
-        debug(f"{'  '*shift}Filling raw command at {addr}")
+    def fill_raw_command(self, addr: int, params_len: int, shift: int):
+        structure = self.structure
+        if debug_active:
+            debug(f"{'  '*shift}Filling raw command at {addr}")
         match structure[addr]:
             case ByteType.COMMAND_TAIL:
-                down_addr = addr - 1
-                while structure[down_addr] == ByteType.COMMAND_TAIL:
-                    down_addr -= 1
-                down_command = int.from_bytes(data[down_addr:down_addr+2], "little")
-                down_params_len = sum(int(par[0]) for par in commands[down_command][2:])
-                structure[down_addr:down_addr+down_params_len+2] = [ByteType.RAW] * (down_params_len+2)
+                down_addr = self.instruction_start(addr)
+                length = self.command_length(down_addr)
+                structure[down_addr:down_addr+length] = tag_run(ByteType.RAW, length)
             case ByteType.ACTION_HEADER:
-                structure[addr:addr+4] = [ByteType.RAW] * 4
+                structure[addr:addr+4] = tag_run(ByteType.RAW, 4)
             case ByteType.ACTION_TAIL:
-                down_addr = addr - 1
-                while structure[down_addr] == ByteType.ACTION_TAIL:
-                    down_addr -= 1
-                structure[down_addr:down_addr+4] = [ByteType.RAW] * 4
+                down_addr = self.instruction_start(addr)
+                structure[down_addr:down_addr+4] = tag_run(ByteType.RAW, 4)
         structure[addr] = ByteType.RAW
         for next_addr in range(addr+1, addr+params_len+2):
             match structure[next_addr]:
                 case ByteType.COMMAND_HEADER:
-                    down_command = int.from_bytes(data[next_addr:next_addr+2], "little")
-                    down_params_len = sum(int(par[0]) for par in commands[down_command][2:])
-                    structure[next_addr:next_addr+down_params_len+2] = [ByteType.RAW] * (down_params_len+2)
+                    length = self.command_length(next_addr)
+                    structure[next_addr:next_addr+length] = tag_run(ByteType.RAW, length)
                 case ByteType.ACTION_HEADER:
-                    structure[next_addr:next_addr+4] = [ByteType.RAW] * 4
+                    structure[next_addr:next_addr+4] = tag_run(ByteType.RAW, 4)
             structure[next_addr] = ByteType.RAW
 
-    def walk_action(addr: int, shift: int):
-        debug(f"{'  '*shift}Walk action at {addr}")
-        while addr < len(data):
+    def skip_raw(self, skips: dict[int, int], run: list[int], addr: int):
+        """
+        Record that walking from any address in run leads to addr without changing anything.
+        run holds instructions that were turned into raw bytes and do not branch. Raw bytes stay raw, so walking
+        over them again retags nothing and finds no new labels. Skipping them keeps data regions that are
+        reached from many places from being walked over and over.
+        """
+        for raw_addr in run:
+            skips[raw_addr] = addr
+        run.clear()
+
+    def walk_action(self, addr: int, shift: int):
+        structure = self.structure
+        skips = self.raw_action_skips
+        run: list[int] = []
+        if debug_active:
+            debug(f"{'  '*shift}Walk action at {addr}")
+        while addr < len(self.data):
             if structure[addr] == ByteType.ACTION_HEADER:
-                debug(f"{'  '*shift}Walk action found header at {addr}")
-                return
-            action = int.from_bytes(data[addr:addr+2], "little")
+                if debug_active:
+                    debug(f"{'  '*shift}Walk action found header at {addr}")
+                break
+            if addr in skips:
+                self.skip_raw(skips, run, addr)
+                addr = skips[addr]
+                continue
+            action = self.decode_action(addr).code
             if structure[addr] in (ByteType.RAW, ByteType.COMMAND_HEADER, ByteType.COMMAND_TAIL, ByteType.ACTION_TAIL):
-                fill_raw_action(addr, shift)
+                self.fill_raw_action(addr, shift)
             else:  # only UNKNOWN at this point
                 for param_addr in range(addr+1, addr+4):
                     if structure[param_addr] in (ByteType.RAW, ByteType.COMMAND_HEADER, ByteType.ACTION_HEADER):
-                        fill_raw_action(addr, shift)
+                        self.fill_raw_action(addr, shift)
                         break
             if structure[addr] == ByteType.UNKNOWN:
                 structure[addr] = ByteType.ACTION_HEADER
-                structure[addr+1:addr+4] = [ByteType.ACTION_TAIL] * 3
-            if action == 0xfe:
-                debug(f"{'  '*shift}EndAction at {addr}")
-                return
+                structure[addr+1:addr+4] = tag_run(ByteType.ACTION_TAIL, 3)
+                self.tail_offsets[addr+1:addr+4] = TAIL_OFFSETS[1:4]
+            if action == END_ACTION:
+                if debug_active:
+                    debug(f"{'  '*shift}EndAction at {addr}")
+                break
+            if structure[addr] == ByteType.RAW:
+                run.append(addr)
+            elif run:
+                self.skip_raw(skips, run, addr)
             addr += 4
+        if run:
+            self.skip_raw(skips, run, addr)
 
-    def walk_command(addr: int, shift: int):
-        try:
-            debug(f"{'  '*shift}Walk command at {addr}")
-            while addr < len(data):
-                if structure[addr] == ByteType.COMMAND_HEADER:
-                    debug(f"{'  '*shift}Walk command found header at {addr}")
-                    return
-                command = int.from_bytes(data[addr:addr+2], "little")
-                params = commands[command][2:]
-                params_len = sum(int(par[0]) for par in params)
-                if structure[addr] in (ByteType.RAW, ByteType.COMMAND_TAIL, ByteType.ACTION_HEADER, ByteType.ACTION_TAIL):
-                    fill_raw_command(addr, params_len, shift)
-                else:  # only UNKNOWN at this point
-                    for param_addr in range(addr+1, addr+params_len+2):
-                        if structure[param_addr] in (ByteType.RAW, ByteType.COMMAND_HEADER, ByteType.ACTION_HEADER):
-                            fill_raw_command(addr, params_len, shift)
-                            break
-                if structure[addr] == ByteType.UNKNOWN:
-                    structure[addr] = ByteType.COMMAND_HEADER
-                    structure[addr+1:addr+params_len+2] = [ByteType.COMMAND_TAIL] * (params_len+1)
-                match command:
-                    case 2:  # if vmhalt, return
-                        debug(f"{'  '*shift}VMHalt at {addr}")
-                        return
-                    case 4:  # if vmcall, branch and add link
-                        link_addr = addr + 2 + params_len + int.from_bytes(data[addr+2:addr+6], "little")
-                        link_addr %= 0x100000000
-                        if link_addr not in links:
-                            links[link_addr] = f"sub{len(links)}"
-                        debug(f"{'  '*shift}VMCall at {addr} to {link_addr}")
-                        walk_command(link_addr, shift+1)
-                    case 5:  # if vmreturn, return
-                        debug(f"{'  '*shift}VMReturn at {addr}")
-                        return
-                    case 0x1e:  # if vmjump, jump and add link
-                        link_addr = addr + 2 + params_len + int.from_bytes(data[addr+2:addr+6], "little")
-                        link_addr %= 0x100000000
-                        if link_addr not in links:
-                            links[link_addr] = f"lbl{script_num}-{len(links)}"
-                        debug(f"{'  '*shift}VMJump at {addr} to {link_addr}")
-                        addr = link_addr
+    def walk_command(self, addr: int, script_num: int, shift: int = 1):
+        """
+        Walk all code reachable from addr.
+        Branches push the address after the branching command and then their target onto the worklist,
+        so the target is walked completely before the walk continues after the branch.
+        """
+        structure = self.structure
+        links = self.links
+        skips = self.raw_command_skips
+        size = len(self.data)
+        worklist: deque[tuple[int, int]] = deque([(addr, shift)])
+        while worklist:
+            addr, shift = worklist.pop()
+            run: list[int] = []
+            if debug_active:
+                debug(f"{'  '*shift}Walk command at {addr}")
+            try:
+                while addr < size:
+                    if structure[addr] == ByteType.COMMAND_HEADER:
+                        if debug_active:
+                            debug(f"{'  '*shift}Walk command found header at {addr}")
+                        break
+                    if addr in skips:
+                        self.skip_raw(skips, run, addr)
+                        addr = skips[addr]
                         continue
-                    case 0x1f:  # if vmjumpif, branch and add link
-                        link_addr = addr + 2 + params_len + int.from_bytes(data[addr+3:addr+7], "little")
-                        link_addr %= 0x100000000
-                        if link_addr not in links:
-                            links[link_addr] = f"lbl{script_num}-{len(links)}"
-                        debug(f"{'  '*shift}VMJumpIf at {addr} to {link_addr}")
-                        walk_command(link_addr, shift+1)
-                    case 0x20:  # if vmcallif, branch and add link
-                        link_addr = addr + 2 + params_len + int.from_bytes(data[addr+3:addr+7], "little")
-                        link_addr %= 0x100000000
-                        if link_addr not in links:
-                            links[link_addr] = f"sub{len(links)}"
-                        debug(f"{'  '*shift}VMCallIf at {addr} to {link_addr}")
-                        walk_command(link_addr, shift+1)
-                    case 0x64:  # if actorcmdexec, branch action and add link
-                        link_addr = addr + 2 + params_len + int.from_bytes(data[addr+4:addr+8], "little")
-                        link_addr %= 0x100000000
-                        if link_addr not in links:
-                            links[link_addr] = f"act{script_num}-{len(links)}"
-                        debug(f"{'  '*shift}ActorCmdExec at {addr} to {link_addr}")
-                        walk_action(link_addr, shift+1)
-                    case 0x8c:  # if CallTrainerLose, return
-                        debug(f"{'  '*shift}CallTrainerLose at {addr}")
-                        return
-                    case 0x17a:  # if CallWildLose, return
-                        debug(f"{'  '*shift}CallWildLose at {addr}")
-                        return
-                addr += params_len + 2
-        except Exception as e:
-            raise Exception(e.args, f"Address {addr}")
+                    instruction = self.decode_command(addr)
+                    op = instruction.op
+                    params_len = op.length - 2
+                    if structure[addr] in (ByteType.RAW, ByteType.COMMAND_TAIL, ByteType.ACTION_HEADER, ByteType.ACTION_TAIL):
+                        self.fill_raw_command(addr, params_len, shift)
+                    else:  # only UNKNOWN at this point
+                        for param_addr in range(addr+1, addr+params_len+2):
+                            if structure[param_addr] in (ByteType.RAW, ByteType.COMMAND_HEADER, ByteType.ACTION_HEADER):
+                                self.fill_raw_command(addr, params_len, shift)
+                                break
+                    if structure[addr] == ByteType.UNKNOWN:
+                        structure[addr] = ByteType.COMMAND_HEADER
+                        structure[addr+1:addr+params_len+2] = tag_run(ByteType.COMMAND_TAIL, params_len+1)
+                        self.tail_offsets[addr+1:addr+params_len+2] = TAIL_OFFSETS[1:params_len+2]
+                    if structure[addr] == ByteType.RAW and op.flow in (FlowKind.NONE, FlowKind.JUMP, FlowKind.ACTOR_EXEC):
+                        run.append(addr)
+                    elif run:
+                        self.skip_raw(skips, run, addr)
+                    link_addr = instruction.target
+                    match op.flow:
+                        case FlowKind.HALT | FlowKind.RETURN:  # if vmhalt, vmreturn, calltrainerlose or callwildlose, stop
+                            if debug_active:
+                                debug(f"{'  '*shift}{op.name} at {addr}")
+                            break
+                        case FlowKind.CALL | FlowKind.CALL_IF:  # if vmcall or vmcallif, branch and add link
+                            if link_addr not in links:
+                                links[link_addr] = f"sub{len(links)}"
+                            if debug_active:
+                                debug(f"{'  '*shift}{op.name} at {addr} to {link_addr}")
+                            worklist.append((addr + op.length, shift))
+                            worklist.append((link_addr, shift+1))
+                            break
+                        case FlowKind.JUMP:  # if vmjump, jump and add link
+                            if link_addr not in links:
+                                links[link_addr] = f"lbl{script_num}-{len(links)}"
+                            if debug_active:
+                                debug(f"{'  '*shift}VMJump at {addr} to {link_addr}")
+                            addr = link_addr
+                            continue
+                        case FlowKind.JUMP_IF:  # if vmjumpif, branch and add link
+                            if link_addr not in links:
+                                links[link_addr] = f"lbl{script_num}-{len(links)}"
+                            if debug_active:
+                                debug(f"{'  '*shift}VMJumpIf at {addr} to {link_addr}")
+                            worklist.append((addr + op.length, shift))
+                            worklist.append((link_addr, shift+1))
+                            break
+                        case FlowKind.ACTOR_EXEC:  # if actorcmdexec, walk action and add link
+                            if link_addr not in links:
+                                links[link_addr] = f"act{script_num}-{len(links)}"
+                            if debug_active:
+                                debug(f"{'  '*shift}ActorCmdExec at {addr} to {link_addr}")
+                            self.walk_action(link_addr, shift+1)
+                    addr += params_len + 2
+            except Exception as e:
+                raise AddressError(e.args, f"Address {addr}", address=addr)
+            if run:
+                self.skip_raw(skips, run, addr)
 
-    script_num = 0
-    for script_addr in scripts:
-        if script_addr not in links:
-            links[script_addr] = f"scr{script_num}"
-            debug(f"Registered link scr{script_num}")
-        script_num += 1
-        walk_command(script_addr, 1)
+    def walk_scripts(self, scripts: list[int]):
+        script_num = 0
+        for script_addr in scripts:
+            if script_addr not in self.links:
+                self.links[script_addr] = f"scr{script_num}"
+                debug(f"Registered link scr{script_num}")
+            script_num += 1
+            self.walk_command(script_addr, script_num)
 
-    pointer = len(scripts) * 4 + 2
-    while pointer < len(data):
-        if structure[pointer] != ByteType.UNKNOWN:
-            pointer += 1
-            continue
-        search = pointer + 1
-        zero = data[pointer] == 0
-        while search < len(data) and structure[search] == ByteType.UNKNOWN:
-            if data[search] != 0:
-                zero = False
-            search += 1
+    def basic_blocks(self) -> dict[int, BasicBlock]:
+        """
+        Split the walked code into basic blocks, by start address.
+        A block starts at a script entry, a label or after a control flow command, and ends with a control flow
+        command or right before the next block. Commands that were turned into raw bytes are not part of any block.
+        """
+        structure = self.structure
+        leaders = set(self.links)
+        blocks: dict[int, BasicBlock] = {}
+        pending = sorted(leaders, reverse=True)
+        while pending:
+            start = pending.pop()
+            if start in blocks or start >= len(structure):
+                continue
+            is_action = structure[start] == ByteType.ACTION_HEADER
+            header = ByteType.ACTION_HEADER if is_action else ByteType.COMMAND_HEADER
+            if structure[start] != header:
+                continue
+            instructions: list[Instruction] = []
+            successors: list[tuple[FlowKind, int]] = []
+            decoded = self.decoded_actions if is_action else self.decoded_commands
+            addr = start
+            while True:
+                instruction = decoded[addr]
+                instructions.append(instruction)
+                if is_action:
+                    next_addr = addr + 4
+                    if instruction.code == END_ACTION:
+                        break
+                else:
+                    op = instruction.op
+                    next_addr = addr + op.length
+                    if op.flow in (FlowKind.HALT, FlowKind.RETURN):
+                        break
+                    if op.flow == FlowKind.JUMP:
+                        successors.append((op.flow, instruction.target))
+                        pending.append(instruction.target)
+                        break
+                    if op.flow != FlowKind.NONE:
+                        successors.append((op.flow, instruction.target))
+                        successors.append((FlowKind.NONE, next_addr))
+                        pending.append(instruction.target)
+                        pending.append(next_addr)
+                        break
+                if next_addr in leaders or next_addr >= len(structure) or structure[next_addr] != header:
+                    if next_addr < len(structure) and structure[next_addr] == header:
+                        successors.append((FlowKind.NONE, next_addr))
+                        pending.append(next_addr)
+                    break
+                addr = next_addr
+            blocks[start] = BasicBlock(start, is_action, instructions, successors)
+        return blocks
+
+
+UNKNOWN_RUN = re.compile(bytes((ByteType.UNKNOWN,)) + b"+")
+RAW_RUN = re.compile(bytes((ByteType.RAW,)) + b"+")
+# raw bytes per _hex line of the disassembly
+RAW_LINE_BYTES = 16
+
+
+def classify_gaps(data: bytes, structure: bytearray, start: int):
+    """
+    Tag every byte not reached by the control flow as RAW, except for zero padding right before an action.
+    Runs of untagged bytes are found and tagged whole, instead of byte by byte.
+    """
+    for run in UNKNOWN_RUN.finditer(structure, start, len(data)):
+        pointer, search = run.span()
         if search >= len(data):
-            structure[pointer:] = [ByteType.RAW] * (len(data) - pointer)
-        elif structure[search] == ByteType.ACTION_HEADER and zero and search - pointer < 4:
-            structure[pointer:search] = [ByteType.IGNORE] * (search - pointer)
+            structure[pointer:] = tag_run(ByteType.RAW, len(data) - pointer)
+        elif structure[search] == ByteType.ACTION_HEADER and search - pointer < 4 \
+                and data[pointer:search] == bytes(search - pointer):
+            structure[pointer:search] = tag_run(ByteType.IGNORE, search - pointer)
         else:
-            structure[pointer:search] = [ByteType.RAW] * (search - pointer)
-        pointer = search+1
+            structure[pointer:search] = tag_run(ByteType.RAW, search - pointer)
 
-    with open(dest, "wt") as out:
-        for script_num in range(len(scripts)):
-            see_write(out, f"{script_num} {links[scripts[script_num]]}")
-        pointer = len(scripts) * 4
-        if data[pointer:pointer+2] == b'\x13\xfd':
-            see_write(out, "# commands")
-            pointer += 2
-        else:
-            see_write(out, "# no stop bytes\n# commands")
-        while pointer < len(data):
-            if pointer in links:
-                if links[pointer][0:3] == "scr":
-                    see_write(out, f"\n# {links[pointer]}")
-                elif links[pointer][0:3] == "lbl":
-                    see_write(out, f"\n   # {links[pointer]}")
-                elif links[pointer][0:3] == "act":
-                    see_write(out, f"\n   # {links[pointer]}")
+
+def analyze(data: bytes, tables: OpcodeTables | None = None) -> tuple[list[int], ControlFlowWalker]:
+    """
+    Full structure analysis of a script file: script table, control flow and the bytes in between.
+    """
+    if tables is None:
+        with timed_phase("tables"):
+            tables = get_opcode_tables()
+    with timed_phase("header"):
+        scripts = read_script_table(data)
+    walker = ControlFlowWalker(data, tables)
+    with timed_phase("walk"):
+        walker.walk_scripts(scripts)
+    with timed_phase("gaps"):
+        classify_gaps(data, walker.structure, len(scripts) * 4 + 2)
+    return scripts, walker
+
+
+def iter_disassembly(data: bytes, scripts: list[int], walker: ControlFlowWalker) -> Iterator[str]:
+    """
+    Generate the lines of the .asm file (without line breaks) from a finished structure analysis.
+    """
+    commands = walker.commands
+    actions = walker.actions
+    structure = walker.structure
+    links = walker.links
+    for script_num in range(len(scripts)):
+        yield f"{script_num} {links[scripts[script_num]]}"
+    pointer = len(scripts) * 4
+    if data[pointer:pointer+2] == b'\x13\xfd':
+        yield "# commands"
+        pointer += 2
+    else:
+        yield "# no stop bytes"
+        yield "# commands"
+    while pointer < len(data):
+        if pointer in links:
+            yield ""
+            if links[pointer][0:3] in ("lbl", "act"):
+                yield f"   # {links[pointer]}"
+            else:
+                yield f"# {links[pointer]}"
+        match structure[pointer]:
+            case ByteType.RAW:
+                # runs of raw bytes go on one _hex line, up to the next label
+                end = RAW_RUN.match(structure, pointer, min(pointer + RAW_LINE_BYTES, len(data))).end()
+                for label_addr in range(pointer + 1, end):
+                    if label_addr in links:
+                        end = label_addr
+                        break
+                if end - pointer == 1:
+                    yield f"    _{hex(data[pointer])}"
                 else:
-                    see_write(out, f"\n# {links[pointer]}")
-            match structure[pointer]:
-                case ByteType.RAW:
-                    see_write(out, f"    _{hex(data[pointer])}")
-                    pointer += 1
-                case ByteType.IGNORE:
-                    pointer += 1
-                case ByteType.COMMAND_HEADER:
-                    comm_num = int.from_bytes(data[pointer:pointer+2], "little")
-                    comm_def = commands[comm_num]
-                    see_write(out, f"    {comm_def[1]}", "")
-                    pointer += 2
-                    if comm_num in (4, 0x1e):
-                        value = int.from_bytes(data[pointer:pointer + 4], 'little')
-                        see_write(out, f" {links[(value+pointer+4)%0x100000000]}")
-                        pointer += 4
-                    elif comm_num in (0x1f, 0x20):
-                        cond = data[pointer]
-                        value = int.from_bytes(data[pointer+1:pointer + 5], 'little')
-                        see_write(out, f" {cond} {links[(value+pointer+5)%0x100000000]}")
-                        pointer += 5
-                    elif comm_num == 0x64:
-                        actor = int.from_bytes(data[pointer:pointer+2], 'little')
-                        value = int.from_bytes(data[pointer+2:pointer+6], 'little')
-                        if actor in range(0x4000, 0x4200) or actor in range(0x8000, 0x8100):
-                            see_write(out, f" {hex(actor)} {links[(value+pointer+6)%0x100000000]}")
-                        else:
-                            see_write(out, f" {actor} {links[(value+pointer+6)%0x100000000]}")
-                        pointer += 6
-                    else:
-                        for param in comm_def[2:]:
-                            length = int(param[0])
-                            value = int.from_bytes(data[pointer:pointer+length], "little")
-                            if value in range(0x4000, 0x4200) or value in range(0x8000, 0x8100) or value in range(0xFF00, 0x10000):
-                                see_write(out, f" {hex(value)}", "")
-                            else:
-                                see_write(out, f" {value}", "")
-                            pointer += length
-                        see_write(out, "")
-                case ByteType.ACTION_HEADER:
-                    act_num = int.from_bytes(data[pointer:pointer+2], "little")
-                    value = int.from_bytes(data[pointer+2:pointer+4], "little")
-                    see_write(out, f"     {actions[act_num][1]} {value}")
-                    pointer += 4
+                    yield f"    _hex {data[pointer:end].hex()}"
+                pointer = end
+            case ByteType.IGNORE:
+                pointer += 1
+            case ByteType.COMMAND_HEADER:
+                comm_def = commands[read_u16(data, pointer)]
+                yield format_command(comm_def, data, pointer, links)
+                pointer += comm_def.length
+            case ByteType.ACTION_HEADER:
+                yield format_action(actions, data, pointer)
+                pointer += 4
 
 
-def assemble(f: PathLike | str, dest: PathLike | str):
-    data = [line.split() for line in get_text_file_lines(f)]
-    command_text = get_text_file_lines("commands.txt")
-    action_text = get_text_file_lines("actions.txt")
-    commands: dict[str, tuple[list[str], int]] = {}
-    actions: dict[str, int] = {}
-    for line in command_text:
-        c = line.split()
-        commands[c[1]] = (c[2:], int(c[0], 16))
-        debug(f"Registered command {c}")
-    for line in action_text:
-        a = line.split()
-        actions[a[1]] = int(a[0], 16)
-        debug(f"Registered action {a}")
+def format_command(comm_def: Opcode, data: bytes, pointer: int, links: dict[int, str]) -> str:
+    """
+    The .asm line of the command at pointer, with jump targets replaced by their label.
+    """
+    values = unpack_command(comm_def, data, pointer)
+    match comm_def.flow:
+        case FlowKind.CALL | FlowKind.JUMP:
+            return f"    {comm_def.name} {links[(values[1]+pointer+comm_def.length)%0x100000000]}"
+        case FlowKind.JUMP_IF | FlowKind.CALL_IF:
+            return f"    {comm_def.name} {values[1]} {links[(values[2]+pointer+comm_def.length)%0x100000000]}"
+        case FlowKind.ACTOR_EXEC:
+            actor = values[1]
+            if 0x4000 <= actor < 0x4200 or 0x8000 <= actor < 0x8100:
+                actor = hex(actor)
+            return f"    {comm_def.name} {actor} {links[(values[2]+pointer+comm_def.length)%0x100000000]}"
+        case _:
+            words = [f"    {comm_def.name}"]
+            for value in values[1:]:
+                if 0x4000 <= value < 0x4200 or 0x8000 <= value < 0x8100 or 0xFF00 <= value < 0x10000:
+                    words.append(hex(value))
+                else:
+                    words.append(str(value))
+            return " ".join(words)
+
+
+def format_action(actions: dict[int, Opcode], data: bytes, pointer: int) -> str:
+    if pointer + 4 <= len(data):
+        act_num, value = ACTION_FIELDS.unpack_from(data, pointer)
+    else:
+        act_num = read_u16(data, pointer)
+        value = int.from_bytes(data[pointer+2:pointer+4], "little")
+    return f"     {actions[act_num].name} {value}"
+
+
+def write_disassembly(out: TextIO, data: bytes, scripts: list[int], walker: ControlFlowWalker,
+                      echo: TextIO | None = None):
+    """
+    Write the whole .asm file at once, and also to echo if given (or to stdout if print_disassembly is set).
+    """
+    with timed_phase("emit"):
+        text = "\n".join(iter_disassembly(data, scripts, walker)) + "\n"
+    out.write(text)
+    if echo is None and print_disassembly:
+        echo = sys.stdout
+    if echo is not None:
+        echo.write(text)
 
-    links: dict[str, int] = {}
-    assembly: bytearray = bytearray()
-    # {calling address: label name}
-    link_calls: dict[int, str] = {}
 
+def disassemble_bytes(data: bytes, tables: OpcodeTables | None = None) -> str:
+    """
+    Disassemble a script file in memory, returning the text of the .asm file.
+    """
+    scripts, walker = analyze(data, tables)
+    with timed_phase("emit"):
+        return "\n".join(iter_disassembly(data, scripts, walker)) + "\n"
+
+
+def disassemble(f: PathLike | str, dest: PathLike | str):
+    data = get_file_as_bytes(f)
+    key = None
+    if result_cache is not None:
+        key = result_cache.key("asm", data)
+        if result_cache.copy_to(key, "asm", dest):
+            return
+    scripts, walker = analyze(data)
+    with open(dest, "wt") as out:
+        write_disassembly(out, data, scripts, walker)
+    if key is not None:
+        result_cache.put_file(key, "asm", dest)
+
+
+class ScriptListing(NamedTuple):
+    index: int
+    entry: int
+    # every command and action reachable from the entry, by address
+    instructions: list[Instruction]
+    # label of every jump target and of the entry, by address
+    labels: dict[int, str]
+    # addresses of the instructions that are actions
+    actions: set[int]
+
+
+class LazyDisassembler:
+    """
+    Random access disassembly of single scripts of a file, for quick lookups and editor tooling.
+    Only the code reachable from the requested script entry is decoded, through a decode cache shared by all
+    queries, so asking for another script that calls the same subroutines decodes nothing twice.
+    Labels are named by address, because the numbering of a full disassembly depends on every other script.
+    Instructions that a full disassembly would turn into raw bytes, because they overlap with code reached
+    from another script, are shown as decoded from this entry.
+    """
+
+    def __init__(self, data: bytes, tables: OpcodeTables | None = None):
+        self.data = data
+        # only used for its decode cache, the structure of the whole file is never analysed
+        self.walker = ControlFlowWalker(data, tables)
+        self.scripts = read_script_table(data)
+        self.listings: dict[int, ScriptListing] = {}
+
+    def __len__(self) -> int:
+        return len(self.scripts)
+
+    def script(self, index: int) -> ScriptListing:
+        if index in self.listings:
+            return self.listings[index]
+        if not 0 <= index < len(self.scripts):
+            raise Exception(f"Script {index} out of range, the file has {len(self.scripts)} scripts")
+        walker = self.walker
+        size = len(self.data)
+        entry = self.scripts[index]
+        labels = {entry: f"scr{index}"}
+        instructions: dict[int, Instruction] = {}
+        actions: set[int] = set()
+        worklist: list[tuple[int, bool]] = [(entry, False)]
+        while worklist:
+            addr, is_action = worklist.pop()
+            try:
+                while addr < size and addr not in instructions:
+                    if is_action:
+                        instruction = walker.decode_action(addr)
+                        instructions[addr] = instruction
+                        actions.add(addr)
+                        if instruction.code == END_ACTION:
+                            break
+                        addr += 4
+                        continue
+                    instruction = walker.decode_command(addr)
+                    instructions[addr] = instruction
+                    op = instruction.op
+                    target = instruction.target
+                    match op.flow:
+                        case FlowKind.HALT | FlowKind.RETURN:
+                            break
+                        case FlowKind.CALL | FlowKind.CALL_IF:
+                            labels.setdefault(target, f"sub_{target:x}")
+                            worklist.append((target, False))
+                        case FlowKind.JUMP:
+                            labels.setdefault(target, f"lbl_{target:x}")
+                            addr = target
+                            continue
+                        case FlowKind.JUMP_IF:
+                            labels.setdefault(target, f"lbl_{target:x}")
+                            worklist.append((target, False))
+                        case FlowKind.ACTOR_EXEC:
+                            labels.setdefault(target, f"act_{target:x}")
+                            worklist.append((target, True))
+                    addr += op.length
+            except Exception as e:
+                raise AddressError(e.args, f"Address {addr}", address=addr)
+        listing = ScriptListing(index, entry, [instructions[addr] for addr in sorted(instructions)], labels,
+                                actions)
+        self.listings[index] = listing
+        return listing
+
+    def iter_script(self, index: int) -> Iterator[str]:
+        """
+        Generate the .asm lines of one script and everything it calls, in address order.
+        A blank line separates pieces of code that are not adjacent in the file.
+        """
+        listing = self.script(index)
+        data = self.data
+        labels = listing.labels
+        end = None
+        for instruction in listing.instructions:
+            addr = instruction.addr
+            if end is not None and (addr in labels or addr != end):
+                yield ""
+            if addr in labels:
+                yield f"# {labels[addr]}"
+            if addr in listing.actions:
+                yield format_action(self.walker.actions, data, addr)
+                end = addr + 4
+            else:
+                yield format_command(instruction.op, data, addr, labels)
+                end = addr + instruction.op.length
+
+
+class EncodedBlock(NamedTuple):
+    # encoded commands, actions and raw bytes, with zeros in place of label references
+    code: bytes
+    # where the label of the block ends up, which is moved forward if the block starts with an aligned action
+    label_offset: int
+    # (offset in code, label name) of every 4 byte label reference
+    references: list[tuple[int, str]]
+
+
+def split_script_list(data: list[list[str]]) -> tuple[list[list[str]], bool, list[list[str]]]:
+    """
+    Split the words of each line of an .asm file into the script list and the command lines.
+    Also returns whether the stop bytes are written after the script list.
+    """
     # search "# command"
     for l in range(len(data)):
         words = data[l]
@@ -349,12 +926,21 @@ def assemble(f: PathLike | str, dest: PathLike | str):
             break
     else:
         raise Exception("Missing '# commands'")
-    # write script list
     stop_bytes = True
     if len(script_lines) > 0 and script_lines[-1] == ["#", "no", "stop", "bytes"]:
         stop_bytes = False
         script_lines.pop()
         debug(f"# no stop bytes at line {l}")
+    return script_lines, stop_bytes, command_lines
+
+
+def layout_script_list(script_lines: list[list[str]], stop_bytes: bool) -> tuple[int, dict[int, str]]:
+    """
+    Size the script list, returning its length with the label each script pointer refers to, by address.
+    """
+    size = 0
+    # {calling address: label name}
+    link_calls: dict[int, str] = {}
     for words in script_lines:
         if len(words) == 0:
             continue
@@ -362,97 +948,786 @@ def assemble(f: PathLike | str, dest: PathLike | str):
             raise Exception(f"Bad line in script list: {' '.join(words)}")
         script = int(words[0])
         link_calls[script*4] = words[1]
-        debug(f"Script {script} calling {words[1]}")
-        if len(assembly) < script*4+4:
-            assembly.extend(bytes(script*4+4-len(assembly)))
+        if debug_active:
+            debug(f"Script {script} calling {words[1]}")
+        size = max(size, script*4+4)
     if stop_bytes:
-        assembly.extend(b'\x13\xfd')
-    # write command lines
+        size += 2
+    return size, link_calls
+
+
+def write_script_list(assembly: bytearray, size: int, stop_bytes: bool):
+    """
+    Write the stop bytes at the end of a script list of the given size, the pointers are filled in by link().
+    """
+    if stop_bytes:
+        assembly[size-2:size] = b'\x13\xfd'
+
+
+def is_label_line(words: list[str]) -> bool:
+    if len(words) == 0 or words[0] != "#":
+        return False
+    if len(words) != 2:
+        raise Exception(f"Bad label definition: {' '.join(words)}")
+    return True
+
+
+# struct formats of commands with a label in a parameter that is not 4 bytes wide, by format
+_label_fields: dict[str, struct.Struct] = {}
+
+
+class Layout(NamedTuple):
+    # address and encoding of every command, action and raw byte, label references are left as zeros
+    addrs: list[int]
+    chunks: list[bytes | bytearray]
+    # (address of the 4 byte parameter, label name) of every label reference
+    references: list[tuple[int, str]]
+    links: dict[str, int]
+    end: int
+
+
+def layout_commands(command_lines: list[list[str]], start: int, tables: OpcodeTables) -> Layout:
+    """
+    First assembler pass: parse the command lines starting at address start, find the address of every
+    command, action, raw byte and label, and encode everything except the label references.
+    The encodings are kept as bytes, so the pass does not leave a container per line for the garbage collector.
+    """
+    commands = tables.commands.by_name
+    actions = tables.actions.by_name
+    addrs: list[int] = []
+    chunks: list[bytes | bytearray] = []
+    references: list[tuple[int, str]] = []
+    links: dict[str, int] = {}
+    add_addr = addrs.append
+    add_chunk = chunks.append
+    addr = start
     last_link = ""  # only used for actions right after a label
+    raw_run = None  # consecutive raw bytes are collected into one chunk
     for words in command_lines:
         if len(words) == 0:
             continue
-        if words[0] == "#":
+        first = words[0]
+        # raw bytes first, they are most of the lines of files with unreachable data
+        if first == "_hex":
             if len(words) != 2:
-                raise Exception(f"Bad label definition: {' '.join(words)}")
-            links[words[1]] = len(assembly)
-            last_link = words[1]
-            debug(f"Link {words[1]} to {len(assembly)}")
-        elif words[0].startswith("_"):
-            raw = int(words[0][1:], 16)
+                raise Exception(f"Bad raw bytes: {' '.join(words)}")
+            raw_bytes = bytes.fromhex(words[1])
+            if raw_run is None:
+                raw_run = bytearray()
+                add_addr(addr)
+                add_chunk(raw_run)
+            raw_run += raw_bytes
+            addr += len(raw_bytes)
+            last_link = ""
+            if debug_active:
+                debug(f"Raw {raw_bytes.hex()}")
+        elif first[0] == "_":
+            raw = int(first[1:], 16)
             if raw > 0xff:
                 raise Exception(f"Raw value out of bounds: {' '.join(words)}")
-            assembly.append(raw)
+            if raw_run is None:
+                raw_run = bytearray()
+                add_addr(addr)
+                add_chunk(raw_run)
+            raw_run.append(raw)
+            addr += 1
             last_link = ""
-            debug(f"Raw {raw}")
-        elif words[0] in commands:
-            given_param_count = len(words) - 1
-            needed_param_count = len(commands[words[0]][0])
-            if given_param_count != needed_param_count:
+            if debug_active:
+                debug(f"Raw {raw}")
+        elif first in commands:
+            op = commands[first]
+            widths = op.widths
+            if len(words) - 1 != len(widths):
                 raise Exception(f"Param count mismatch: {' '.join(words)}")
-            command = commands[words[0]][1]
-            param_lengths = [int(p[0]) for p in commands[words[0]][0]]
-            assembly.extend(command.to_bytes(2, "little"))
-            last_link = ""
-            debug(f"Command {' '.join(words)}")
-            for param_num in range(given_param_count):
-                param_val = words[param_num+1]
+            values = [op.code]
+            fields = op.fields
+            param_addr = addr + 2
+            for param_num in range(1, len(words)):
+                param_val = words[param_num]
                 if param_val.isnumeric():
-                    assembly.extend(int(param_val).to_bytes(param_lengths[param_num], "little"))
+                    values.append(int(param_val))
+                    param_addr += widths[param_num-1]
                 elif param_val.startswith("0x"):
-                    assembly.extend(int(param_val, 16).to_bytes(param_lengths[param_num], "little"))
+                    values.append(int(param_val, 16))
+                    param_addr += widths[param_num-1]
                 else:
-                    link_calls[len(assembly)] = param_val
-                    assembly.extend(b"\0\0\0\0")
-                    debug(f"    Calling link {param_val}")
-        elif words[0] in actions:
+                    # labels are always written as 4 byte relative jumps, no matter the parameter
+                    references.append((param_addr, param_val))
+                    values.append(0)
+                    if widths[param_num-1] != 4:
+                        fields = None
+                    param_addr += 4
+                    if debug_active:
+                        debug(f"    Calling link {param_val}")
+            if fields is None:
+                fmt = "<H" + "".join("I" if not (words[param_num+1].isnumeric() or words[param_num+1].startswith("0x"))
+                                     else WIDTH_FORMATS[width] for param_num, width in enumerate(widths))
+                if fmt not in _label_fields:
+                    _label_fields[fmt] = struct.Struct(fmt)
+                fields = _label_fields[fmt]
+            add_addr(addr)
+            add_chunk(fields.pack(*values))
+            addr = param_addr
+            last_link = ""
+            raw_run = None
+            if debug_active:
+                debug(f"Command {' '.join(words)}")
+        elif first == "#":
+            if len(words) != 2:
+                raise Exception(f"Bad label definition: {' '.join(words)}")
+            links[words[1]] = addr
+            last_link = words[1]
+            if debug_active:
+                debug(f"Link {words[1]} to {addr}")
+        elif first in actions:
             if len(words) != 2:
                 raise Exception(f"Bad action call: {' '.join(words)}")
-            if last_link != "" and links[last_link] % 4 != 0:
-                links[last_link] += (4 - (links[last_link] % 4))
-            action = actions[words[0]]
-            value = int(words[1])
-            if len(assembly) % 4 != 0:
-                assembly.extend(bytes(4 - (len(assembly) % 4)))
-            assembly.extend(action.to_bytes(2, "little"))
-            assembly.extend(value.to_bytes(2, "little"))
+            if addr % 4 != 0:
+                addr += 4 - addr % 4
+                if last_link != "":
+                    links[last_link] = addr
+            add_addr(addr)
+            add_chunk(ACTION_FIELDS.pack(actions[first].code, int(words[1])))
+            addr += 4
             last_link = ""
-            debug(f"Action {' '.join(words)}")
+            raw_run = None
+            if debug_active:
+                debug(f"Action {' '.join(words)}")
         else:
             raise Exception(f"Unknown command: {' '.join(words)}")
-    # fill link calls
+    return Layout(addrs, chunks, references, links, addr)
+
+
+def write_layout(buffer: bytearray, layout: Layout, base: int, links: dict[str, int] | None):
+    """
+    Second assembler pass: copy every encoding into buffer, which starts at address base and is already
+    large enough. With links, label references are resolved by writing them right into buffer.
+    """
+    view = memoryview(buffer)
+    for addr, chunk in zip(layout.addrs, layout.chunks):
+        addr -= base
+        view[addr:addr+len(chunk)] = chunk
+    if links is not None:
+        for param_addr, link_name in layout.references:
+            if link_name not in links:
+                raise Exception(f"Unknown label: {link_name}")
+            U32.pack_into(buffer, param_addr - base, (links[link_name] - param_addr - 4) % 0x100000000)
+    view.release()
+
+
+def encode_block(block_lines: list[list[str]], start: int, tables: OpcodeTables) -> EncodedBlock:
+    """
+    Encode the lines between two labels, for a block starting at address start.
+    Only start % 4 matters for the result, because actions are aligned to 4 bytes.
+    """
+    layout = layout_commands(block_lines, start, tables)
+    code = bytearray(layout.end - start)
+    write_layout(code, layout, start, None)
+    label_offset = 0
+    # a label right before an action points to the aligned action, not to the end of the previous block
+    first = next((words[0] for words in block_lines if len(words) > 0), None)
+    if first is not None and first not in tables.commands.by_name and first in tables.actions.by_name:
+        label_offset = layout.addrs[0] - start
+    return EncodedBlock(bytes(code), label_offset, [(param_addr - start, link_name)
+                                                    for param_addr, link_name in layout.references])
+
+
+def link(assembly: bytearray, link_calls: dict[int, str], links: dict[str, int]):
     for addr, link_name in link_calls.items():
         if link_name not in links:
             raise Exception(f"Unknown label: {link_name}")
         jump = ((links[link_name]-addr-4) % 0x100000000)
         assembly[addr:addr+4] = jump.to_bytes(4, "little")
-        debug(f"Linking param at address {hex(addr)} to {hex(links[link_name])}, jumping {hex(jump)}")
+        if debug_active:
+            debug(f"Linking param at address {hex(addr)} to {hex(links[link_name])}, jumping {hex(jump)}")
+
+
+def assemble_lines(lines: Iterable[str], tables: OpcodeTables | None = None) -> bytearray:
+    """
+    Assemble the lines of an .asm file in memory, returning the script file.
+    The first pass finds the address of every label and the size of the file,
+    the second one writes everything into a buffer of exactly that size.
+    """
+    if tables is None:
+        with timed_phase("tables"):
+            tables = get_opcode_tables()
+    with timed_phase("parse"):
+        script_lines, stop_bytes, command_lines = split_script_list([line.split() for line in lines])
+        header_size, link_calls = layout_script_list(script_lines, stop_bytes)
+        layout = layout_commands(command_lines, header_size, tables)
+    with timed_phase("encode"):
+        assembly = bytearray(layout.end)
+        write_script_list(assembly, header_size, stop_bytes)
+        write_layout(assembly, layout, 0, layout.links)
+    with timed_phase("link"):
+        link(assembly, link_calls, layout.links)
+    return assembly
+
+
+class IncrementalAssembler:
+    """
+    Assembler for repeated builds of the same .asm files, which only encodes the blocks between labels
+    that changed since the last build of a file, and only patches label references that moved.
+    The result is always the same as assemble_lines().
+    """
+
+    def __init__(self, tables: OpcodeTables | None = None):
+        if tables is None:
+            tables = get_opcode_tables()
+        self.tables = tables
+        # per file: {(hash of the block lines, block start % 4): encoded block} of the last build
+        self.encoded: dict[str, dict[tuple[bytes, int], EncodedBlock]] = {}
+        # per file: {(hash of the block lines, block start): (addresses of the referenced labels, linked code)}
+        self.placed: dict[str, dict[tuple[bytes, int], tuple[tuple[int, ...], bytes]]] = {}
+        self.encoded_blocks = 0
+        self.reused_blocks = 0
+
+    def forget(self, name: str):
+        """
+        Drop the caches of a file, its next build encodes every block again.
+        """
+        self.encoded.pop(name, None)
+        self.placed.pop(name, None)
+
+    def assemble_lines(self, lines: Iterable[str], name: str = "") -> bytes:
+        """
+        Assemble an .asm file, name tells apart the files built with this assembler.
+        """
+        lines = list(lines)
+        # only lines with a "#" can start a block, everything else is left unparsed until its block changed
+        label_lines = [l for l in range(len(lines)) if "#" in lines[l] and lines[l].split()[0] == "#"]
+        for l in label_lines:
+            if lines[l].split() == ["#", "commands"]:
+                commands_line = l
+                break
+        else:
+            raise Exception("Missing '# commands'")
+        script_lines, stop_bytes, _ = split_script_list([line.split() for line in lines[:commands_line+1]])
+        header_size, link_calls = layout_script_list(script_lines, stop_bytes)
+        assembly = bytearray(header_size)
+        write_script_list(assembly, header_size, stop_bytes)
+
+        old_encoded = self.encoded.get(name, {})
+        old_placed = self.placed.get(name, {})
+        encoded: dict[tuple[bytes, int], EncodedBlock] = {}
+        placed: dict[tuple[bytes, int], tuple[tuple[int, ...], bytes]] = {}
+        # layout: (label, block key, block start, encoded block)
+        layout: list[tuple[str | None, bytes, int, EncodedBlock]] = []
+        links: dict[str, int] = {}
+        starts = [l for l in label_lines if l > commands_line]
+        bounds = [commands_line + 1, *starts, len(lines)]
+        address = header_size
+        for i in range(len(bounds) - 1):
+            if i == 0:
+                label = None
+                block_source = lines[bounds[0]:bounds[1]]
+                if bounds[1] == bounds[0]:
+                    continue
+            else:
+                label_words = lines[bounds[i]].split()
+                is_label_line(label_words)
+                label = label_words[1]
+                block_source = lines[bounds[i]+1:bounds[i+1]]
+            block_hash = hashlib.blake2b("\n".join(block_source).encode(), digest_size=16).digest()
+            key = (block_hash, address % 4)
+            block = encoded.get(key) or old_encoded.get(key)
+            if block is None:
+                block = encode_block([line.split() for line in block_source], address, self.tables)
+                self.encoded_blocks += 1
+            else:
+                self.reused_blocks += 1
+            encoded[key] = block
+            if label is not None:
+                links[label] = address + block.label_offset
+            layout.append((label, block_hash, address, block))
+            address += len(block.code)
+
+        link(assembly, link_calls, links)
+        parts = [assembly]
+        for label, block_hash, start, block in layout:
+            for offset, link_name in block.references:
+                if link_name not in links:
+                    raise Exception(f"Unknown label: {link_name}")
+            targets = tuple(links[link_name] for offset, link_name in block.references)
+            key = (block_hash, start)
+            previous = placed.get(key) or old_placed.get(key)
+            if previous is not None and previous[0] == targets:
+                code = previous[1]
+            elif len(block.references) == 0:
+                code = block.code
+            else:
+                code = bytearray(block.code)
+                for (offset, link_name), target in zip(block.references, targets):
+                    jump = (target - (start + offset) - 4) % 0x100000000
+                    code[offset:offset+4] = jump.to_bytes(4, "little")
+                code = bytes(code)
+            placed[key] = (targets, code)
+            parts.append(code)
+        self.encoded[name] = encoded
+        self.placed[name] = placed
+        return b"".join(parts)
+
+
+def assemble(f: PathLike | str, dest: PathLike | str):
+    if result_cache is None:
+        assembly = assemble_lines(get_text_file_lines(f))
+    else:
+        assembly = assemble_cached(get_file_as_bytes(f))
     with open(dest, "wb") as out:
         out.write(assembly)
 
 
-if __name__ == "__main__":
-    # debug_active = True
-    # print_disassembly = True
-    # for i in [852]:
-    for i in [*range(0, 853, 2), *range(854, 899)]:
-    # for i in [*range(154, 853, 2), *range(854, 899)]:
-        if i < 10:
-            ii = f"00{i}"
-        elif i < 100:
-            ii = f"0{i}"
+def assemble_cached(text: bytes, tables: OpcodeTables | None = None) -> bytes | bytearray:
+    """
+    Assemble the bytes of an .asm file through result_cache.
+    """
+    key = result_cache.key("bin", text)
+    assembly = result_cache.get(key, "bin")
+    if assembly is None:
+        assembly = assemble_lines(text.decode().splitlines(), tables)
+        result_cache.put(key, "bin", assembly)
+    return assembly
+
+
+class RoundTripMismatch(NamedTuple):
+    # first address where the reassembled file differs from the original
+    offset: int
+    original_size: int
+    reassembled_size: int
+    # what the disassembler made of the bytes at offset
+    instruction: str
+
+
+def describe_address(data: bytes, scripts: list[int], walker: ControlFlowWalker, addr: int) -> str:
+    """
+    Describe the command, action or raw byte that covers addr, together with the closest label before it.
+    """
+    if addr < len(scripts) * 4:
+        return f"script table entry {addr // 4}"
+    if addr >= len(data):
+        return f"end of file at {hex(len(data))}"
+    structure = walker.structure
+    start = addr
+    match structure[addr]:
+        case ByteType.COMMAND_HEADER | ByteType.COMMAND_TAIL:
+            if structure[start] == ByteType.COMMAND_TAIL:
+                start = walker.instruction_start(start)
+            what = walker.decode_command(start).op.name
+        case ByteType.ACTION_HEADER | ByteType.ACTION_TAIL:
+            if structure[start] == ByteType.ACTION_TAIL:
+                start = walker.instruction_start(start)
+            action = walker.decode_action(start)
+            what = action.op.name if action.op is not None else f"action {hex(action.code)}"
+        case ByteType.IGNORE:
+            what = "padding"
+        case _:
+            what = "raw byte"
+    labels = [link for link in walker.links if link <= start]
+    if len(labels) > 0:
+        label = max(labels)
+        return f"{what} at {hex(start)} ({walker.links[label]}+{hex(start - label)})"
+    return f"{what} at {hex(start)}"
+
+
+def roundtrip_bytes(data: bytes, tables: OpcodeTables | None = None) -> RoundTripMismatch | None:
+    """
+    Disassemble and reassemble a script file in memory.
+    Returns None if the result is the same as the original, or where it first differs.
+    """
+    scripts, walker = analyze(data, tables)
+    reassembled = assemble_lines(iter_disassembly(data, scripts, walker), tables)
+    if reassembled == data:
+        return None
+    offset = min(len(data), len(reassembled))
+    for addr in range(offset):
+        if data[addr] != reassembled[addr]:
+            offset = addr
+            break
+    return RoundTripMismatch(offset, len(data), len(reassembled), describe_address(data, scripts, walker, offset))
+
+
+def roundtrip_cached(data: bytes, tables: OpcodeTables | None = None) -> RoundTripMismatch | None:
+    """
+    roundtrip_bytes() through result_cache, files that round tripped before are not checked again.
+    Only successful round trips are stored, so a mismatch is always reported in full.
+    """
+    if result_cache is None:
+        return roundtrip_bytes(data, tables)
+    key = result_cache.key("ok", data)
+    if result_cache.get(key, "ok") is not None:
+        return None
+    mismatch = roundtrip_bytes(data, tables)
+    if mismatch is None:
+        result_cache.put(key, "ok", b"")
+    return mismatch
+
+
+def expand_inputs(inputs: list[str], pattern: str = "*") -> list[Path]:
+    """
+    Turn directories and glob patterns into a sorted list of files, keeping the order of the arguments.
+    """
+    files: list[Path] = []
+    for arg in inputs:
+        path = Path(arg)
+        if path.is_dir():
+            found = [p for p in path.glob(pattern) if p.is_file()]
+        elif path.is_file():
+            found = [path]
         else:
-            ii = str(i)
+            found = [Path(p) for p in glob.glob(arg) if Path(p).is_file()]
+            if len(found) == 0:
+                raise FileNotFoundError(f"No input files for {arg}")
+        files.extend(sorted(found))
+    return files
+
+
+def init_worker(debug_enabled: bool, table_cache: str | None, cache: str | None = None, cache_size: int = 0):
+    global debug_active, table_cache_dir, result_cache
+    debug_active = debug_enabled
+    table_cache_dir = table_cache
+    tables = get_opcode_tables()
+    result_cache = open_result_cache(cache, cache_size, tables) if cache is not None else None
+
+
+def run_job(job: tuple[str, str, dict[str, str | None]]) -> dict:
+    """
+    Run one (dis)assembly job of the CLI and describe the result as a json serializable dict.
+    """
+    mode, f, outputs = job
+    result: dict = {"file": f, "mode": mode, "status": "ok"}
+    lookups = cache_lookups()
+    try:
+        match mode:
+            case "disassemble":
+                disassemble(f, outputs["asm"])
+                result["output"] = outputs["asm"]
+            case "assemble":
+                assemble(f, outputs["bin"])
+                result["output"] = outputs["bin"]
+            case "roundtrip":
+                data = get_file_as_bytes(f)
+                if outputs["asm"] is None and outputs["bin"] is None:
+                    mismatch = roundtrip_cached(data)
+                else:
+                    text = disassemble_bytes(data)
+                    reassembled = assemble_lines(text.splitlines())
+                    if outputs["asm"] is not None:
+                        with open(outputs["asm"], "wt") as out:
+                            out.write(text)
+                    if outputs["bin"] is not None:
+                        with open(outputs["bin"], "wb") as out:
+                            out.write(reassembled)
+                    mismatch = roundtrip_bytes(data) if reassembled != data else None
+                if mismatch is not None:
+                    result["status"] = "mismatch"
+                    result.update(mismatch._asdict())
+    except Exception as e:
+        set_error(result, e)
+    set_cache_status(result, lookups)
+    return result
+
+
+def cache_lookups() -> tuple[int, int]:
+    """
+    Hits and misses of result_cache so far.
+    """
+    if result_cache is None:
+        return 0, 0
+    return result_cache.hits, result_cache.misses
+
+
+def set_cache_status(result: dict, lookups: tuple[int, int]):
+    """
+    Record in result whether it came from result_cache, given cache_lookups() before the job.
+    Nothing is recorded for jobs that did not look at the cache.
+    """
+    if result_cache is None or cache_lookups() == lookups:
+        return
+    result["cache"] = "hit" if result_cache.hits > lookups[0] else "miss"
+
+
+def set_error(result: dict, e: Exception):
+    result["status"] = "error"
+    result["error"] = repr(e.args)
+    result["address"] = e.address if isinstance(e, AddressError) else None
+
+
+def parse_member_spec(spec: str | None, count: int) -> list[int]:
+    """
+    Turn a member selection like "0-852:2,854-898" (inclusive ranges with an optional step) into member indices.
+    None selects every member.
+    """
+    if spec is None:
+        return list(range(count))
+    members = []
+    for part in spec.split(","):
+        part, _, step = part.partition(":")
+        first, _, last = part.partition("-")
         try:
-            original = f"assembled unknown/7_{ii}"
-            text = f"disassembled/{ii}.asm"
-            reassembled = f"reassembled/{ii}.bin"
-            disassemble(original, text)
-            assemble(text, reassembled)
-            if get_file_as_bytes(original) == get_file_as_bytes(reassembled):
-                print(f"{ii} original == disassembled")
+            members.extend(range(int(first), int(last or first) + 1, int(step or 1)))
+        except ValueError:
+            raise Exception(f"Bad member selection: {part}{':' if step else ''}{step}")
+    for member in members:
+        if member >= count:
+            raise Exception(f"Member {member} out of range, the archive has {count} members")
+    return members
+
+
+def member_file_name(member: int, count: int) -> str:
+    return f"{member:0{max(3, len(str(count - 1)))}}.asm"
+
+
+def file_name_member(name: str) -> int | None:
+    """
+    The member an .asm file is for: the number after the last "_" of its name, so that both the names
+    disassemble-narc writes (852.asm) and those of disassembled extracted files (7_852.asm) are found.
+    """
+    number = name.removesuffix(".asm").rpartition("_")[2]
+    return int(number) if number.isdecimal() else None
+
+
+def disassemble_narc(archive: PathLike | str, dest_dir: PathLike | str,
+                     members: list[int] | None = None) -> Iterator[dict]:
+    """
+    Disassemble members of a script archive into dest_dir, reading the archive only once.
+    Yields the result of each member in the same form as the CLI summary.
+    """
+    tables = get_opcode_tables()
+    os.makedirs(dest_dir, exist_ok=True)
+    with narc.Narc(archive) as container:
+        for member in range(len(container)) if members is None else members:
+            dest = os.path.join(dest_dir, member_file_name(member, len(container)))
+            result: dict = {"file": str(archive), "member": member, "mode": "disassemble", "status": "ok"}
+            lookups = cache_lookups()
+            try:
+                data = container.members[member]
+                key = result_cache.key("asm", data) if result_cache is not None else None
+                if key is None or not result_cache.copy_to(key, "asm", dest):
+                    text = disassemble_bytes(data, tables)
+                    with open(dest, "wt") as out:
+                        out.write(text)
+                    if key is not None:
+                        result_cache.put_file(key, "asm", dest)
+                result["output"] = dest
+            except Exception as e:
+                set_error(result, e)
+            set_cache_status(result, lookups)
+            yield result
+
+
+def assemble_narc(archive: PathLike | str, asm_dir: PathLike | str, dest: PathLike | str) -> Iterator[dict]:
+    """
+    Rebuild a script archive, assembling every member that has an .asm file in asm_dir (see file_name_member)
+    and copying the others unchanged from the original archive. .asm files that match no member, or a member
+    that already has one, fail the build.
+    The new archive is written in one go once every member was assembled.
+    """
+    tables = get_opcode_tables()
+    failed = False
+    with narc.Narc(archive) as container:
+        asm_files: dict[int, str] = {}
+        for name in sorted(os.listdir(asm_dir)):
+            if not name.endswith(".asm"):
+                continue
+            asm_file = os.path.join(asm_dir, name)
+            member = file_name_member(name)
+            if member is not None and member < len(container) and member not in asm_files:
+                asm_files[member] = asm_file
+                continue
+            result: dict = {"file": asm_file, "member": member, "mode": "assemble", "status": "ok"}
+            if member is None or member >= len(container):
+                set_error(result, Exception(f"No member {member} in {archive}" if member is not None
+                                            else f"No member number in file name: {name}"))
             else:
-                print(f"{ii} is not equal, that's bad!")
+                set_error(result, Exception(f"Member {member} already built from {asm_files[member]}"))
+            failed = True
+            yield result
+        members: list[bytes | memoryview] = []
+        for member in range(len(container)):
+            if member not in asm_files:
+                members.append(container.members[member])
+                continue
+            asm_file = asm_files[member]
+            result = {"file": asm_file, "member": member, "mode": "assemble", "status": "ok"}
+            lookups = cache_lookups()
+            try:
+                if result_cache is None:
+                    members.append(bytes(assemble_lines(get_text_file_lines(asm_file), tables)))
+                else:
+                    members.append(bytes(assemble_cached(get_file_as_bytes(asm_file), tables)))
+            except Exception as e:
+                set_error(result, e)
+                failed = True
+            set_cache_status(result, lookups)
+            yield result
+        if not failed:
+            # the original archive is still mapped, so it can only be replaced after writing
+            narc.write_narc(f"{dest}.tmp", members, container.name_table, container.padding, container.version)
+    if not failed:
+        os.replace(f"{dest}.tmp", dest)
+
+
+def roundtrip_narc(archive: PathLike | str, members: list[int] | None = None) -> Iterator[dict]:
+    """
+    Round trip members of a script archive in memory.
+    """
+    tables = get_opcode_tables()
+    with narc.Narc(archive) as container:
+        for member in range(len(container)) if members is None else members:
+            result: dict = {"file": str(archive), "member": member, "mode": "roundtrip", "status": "ok"}
+            lookups = cache_lookups()
+            try:
+                mismatch = roundtrip_cached(container.members[member], tables)
+                if mismatch is not None:
+                    result["status"] = "mismatch"
+                    result.update(mismatch._asdict())
+            except Exception as e:
+                set_error(result, e)
+            set_cache_status(result, lookups)
+            yield result
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="(Dis)assembler for Pokémon Black and White scripts.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes, 1 to run everything in this process")
+    parser.add_argument("--summary", default="-", help="file for the json lines summary, - for stdout")
+    parser.add_argument("--table-cache", default=None, help="directory for pickled opcode tables")
+    parser.add_argument("--debug", action="store_true", help="print debug output of the structure analysis")
+    parser.add_argument("--cache", default=None,
+                        help="directory for cached results, unchanged inputs are copied from it instead of rebuilt")
+    parser.add_argument("--cache-size", type=int, default=512,
+                        help="size of the result cache in MiB, the least recently used results are deleted beyond it")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    dis = subparsers.add_parser("disassemble", help="disassemble script files into .asm files")
+    dis.add_argument("inputs", nargs="+", help="script files, directories or glob patterns")
+    dis.add_argument("-o", "--output", default="disassembled", help="directory for the .asm files")
+    asm = subparsers.add_parser("assemble", help="assemble .asm files into script files")
+    asm.add_argument("inputs", nargs="+", help=".asm files, directories or glob patterns")
+    asm.add_argument("-o", "--output", default="reassembled", help="directory for the .bin files")
+    rt = subparsers.add_parser("roundtrip", help="check that disassembling and assembling gives the original file,"
+                                                 " reporting the first differing address")
+    rt.add_argument("inputs", nargs="+", help="script files, directories or glob patterns")
+    rt.add_argument("--asm-dir", default=None, help="also write the .asm files to this directory")
+    rt.add_argument("--bin-dir", default=None, help="also write the reassembled .bin files to this directory")
+    dis_narc = subparsers.add_parser("disassemble-narc", help="disassemble the members of a script archive")
+    dis_narc.add_argument("archive", help="NARC archive with the script files")
+    dis_narc.add_argument("-o", "--output", default="disassembled", help="directory for the .asm files")
+    dis_narc.add_argument("--members", default=None, help="members to disassemble, like 0-852:2,854-898")
+    asm_narc = subparsers.add_parser("assemble-narc", help="rebuild a script archive from .asm files")
+    asm_narc.add_argument("archive", help="original NARC archive, members without .asm files are copied from it")
+    asm_narc.add_argument("asm_dir", help="directory with the .asm files, named by member number")
+    asm_narc.add_argument("-o", "--output", required=True, help="file for the rebuilt archive")
+    rt_narc = subparsers.add_parser("roundtrip-narc", help="round trip the members of a script archive in memory")
+    rt_narc.add_argument("archive", help="NARC archive with the script files")
+    rt_narc.add_argument("--members", default=None, help="members to check, like 0-852:2,854-898")
+    script = subparsers.add_parser("script", help="print one script of a file and the code it calls,"
+                                                  " without analysing the rest of the file")
+    script.add_argument("file", help="script file")
+    script.add_argument("index", type=int, help="number of the script in the script table")
+    args = parser.parse_args(argv)
+    cache_size = args.cache_size * 1024 * 1024
+
+    if args.mode == "script":
+        init_worker(args.debug, args.table_cache)
+        try:
+            lazy = LazyDisassembler(get_file_as_bytes(args.file))
+            text = "\n".join(lazy.iter_script(args.index)) + "\n"
         except Exception as e:
-            print(f"{ii} failed: {e.args}")
-            # raise e
+            result: dict = {"file": args.file, "script": args.index, "mode": "script", "status": "ok"}
+            set_error(result, e)
+            return write_summary([result], args.summary)
+        sys.stdout.write(text)
+        return 0
+
+    if args.mode.endswith("-narc"):
+        # archives are handled in this process, as they are read and written in one go
+        init_worker(args.debug, args.table_cache, args.cache, cache_size)
+        try:
+            with narc.Narc(args.archive) as container:
+                members = parse_member_spec(getattr(args, "members", None), len(container))
+            if args.mode == "assemble-narc" and not os.path.isdir(args.asm_dir):
+                raise Exception(f"Not a directory: {args.asm_dir}")
+        except Exception as e:
+            # a bad archive or member selection fails the whole run before any member is touched
+            result: dict = {"file": args.archive, "mode": args.mode.removesuffix("-narc"), "status": "ok"}
+            set_error(result, e)
+            return write_summary([result], args.summary)
+        match args.mode:
+            case "disassemble-narc":
+                results = disassemble_narc(args.archive, args.output, members)
+            case "assemble-narc":
+                results = assemble_narc(args.archive, args.asm_dir, args.output)
+            case _:
+                results = roundtrip_narc(args.archive, members)
+        return write_summary(results, args.summary, args.cache)
+
+    files: list[Path] = []
+    missing = []
+    for arg in args.inputs:
+        try:
+            files.extend(expand_inputs([arg], "*.asm" if args.mode == "assemble" else "*"))
+        except FileNotFoundError as e:
+            result = {"file": arg, "mode": args.mode, "status": "ok"}
+            set_error(result, e)
+            missing.append(result)
+    if missing:
+        # inputs that match nothing fail the whole run before any file is touched
+        return write_summary(missing, args.summary)
+    jobs = []
+    for f in files:
+        outputs: dict[str, str | None] = {}
+        match args.mode:
+            case "disassemble":
+                outputs["asm"] = os.path.join(args.output, f.stem + ".asm")
+            case "assemble":
+                outputs["bin"] = os.path.join(args.output, f.stem + ".bin")
+            case "roundtrip":
+                # without output directories the round trip happens in memory only
+                outputs["asm"] = os.path.join(args.asm_dir, f.stem + ".asm") if args.asm_dir else None
+                outputs["bin"] = os.path.join(args.bin_dir, f.stem + ".bin") if args.bin_dir else None
+        for out_file in outputs.values():
+            if out_file is not None:
+                os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+        jobs.append((args.mode, str(f), outputs))
+
+    worker_args = (args.debug, args.table_cache, args.cache, cache_size)
+    if args.jobs <= 1:
+        init_worker(*worker_args)
+        return write_summary(map(run_job, jobs), args.summary, args.cache)
+    with ProcessPoolExecutor(args.jobs, initializer=init_worker, initargs=worker_args) as executor:
+        # results come back in the order of the jobs, no matter which worker finished first
+        return write_summary(executor.map(run_job, jobs, chunksize=max(1, len(jobs) // (args.jobs * 4))),
+                             args.summary, args.cache)
+
+
+def write_summary(results: Iterable[dict], f: str, cache: str | None = None) -> int:
+    """
+    Write one json line per result, returning the exit code of the CLI.
+    With a result cache, its hits and misses over all workers are reported on stderr at the end.
+    """
+    summary = sys.stdout if f == "-" else open(f, "wt")
+    failures = 0
+    hits = 0
+    misses = 0
+    try:
+        for result in results:
+            if result["status"] != "ok":
+                failures += 1
+            if result.get("cache") == "hit":
+                hits += 1
+            elif result.get("cache") == "miss":
+                misses += 1
+            summary.write(json.dumps(result) + "\n")
+    finally:
+        if summary is not sys.stdout:
+            summary.close()
+    if cache is not None:
+        stats = ResultCache(cache).stats()
+        print(f"Result cache: {hits} hits, {misses} misses, {stats['entries']} entries, "
+              f"{stats['bytes'] / (1024 * 1024):.1f} MiB", file=sys.stderr)
+    return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,369 @@
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import stat
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from os import PathLike
+from typing import Any, Callable, NamedTuple
+
+import script_editing
+from script_editing import AddressError, IncrementalAssembler, OpcodeTables, get_opcode_tables
+
+
+# json-rpc error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+# longest request line, .asm files are sent whole
+LINE_LIMIT = 64 * 1024 * 1024
+# latencies kept per method for the percentiles in stats
+LATENCY_WINDOW = 1000
+
+
+class RequestError(Exception):
+    """
+    Error that is sent back as the json-rpc error of a request.
+    """
+
+    def __init__(self, code: int, message: str, data: dict | None = None):
+        super().__init__(message)
+        self.code = code
+        self.data = data
+
+
+class CachedFile(NamedTuple):
+    # modification time and size when the file was read
+    stamp: tuple[int, int]
+    data: bytes
+    # results worked out from data, like the disassembly text, by kind
+    results: dict[str, Any]
+
+
+class FileCache:
+    """
+    Contents of recently used files and the results worked out from them,
+    dropped when the modification time or size of the file changes.
+    """
+
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self.files: OrderedDict[str, CachedFile] = OrderedDict()
+        self.lock = threading.Lock()
+        self.result_hits = 0
+        self.result_misses = 0
+
+    def get(self, f: PathLike | str) -> CachedFile:
+        path = os.path.abspath(f)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if path in self.files and self.files[path].stamp == stamp:
+                self.files.move_to_end(path)
+                return self.files[path]
+        cached = CachedFile(stamp, script_editing.get_file_as_bytes(path), {})
+        with self.lock:
+            self.files[path] = cached
+            self.files.move_to_end(path)
+            while len(self.files) > self.max_files:
+                self.files.popitem(last=False)
+        return cached
+
+    def read(self, f: PathLike | str) -> bytes:
+        return self.get(f).data
+
+    def result(self, f: PathLike | str, kind: str, compute: Callable[[bytes], Any]) -> Any:
+        """
+        The result of compute for the contents of a file, only computed again once the file changed.
+        """
+        cached = self.get(f)
+        if kind in cached.results:
+            self.result_hits += 1
+            return cached.results[kind]
+        self.result_misses += 1
+        # two requests for the same file can both compute it, they get the same result
+        result = compute(cached.data)
+        cached.results[kind] = result
+        return result
+
+
+class ScriptServer:
+    """
+    JSON-RPC server that keeps the opcode tables, recently used files and an IncrementalAssembler in memory.
+    Requests are newline delimited json objects, and every request runs in a thread pool, so a slow request
+    does not hold back the others on the same connection. Responses are sent as soon as they are ready,
+    so they can come back in a different order than the requests, matched by their id.
+    """
+
+    def __init__(self, tables: OpcodeTables | None = None, workers: int = 4, max_files: int = 256):
+        if tables is None:
+            tables = get_opcode_tables()
+        self.tables = tables
+        self.files = FileCache(max_files)
+        self.assembler = IncrementalAssembler(tables)
+        # the assembler keeps its caches per file, so only builds of the same file wait for each other.
+        # Like the files, only the max_files most recently built names are kept
+        self.max_files = max_files
+        self.assembler_locks: OrderedDict[str, threading.Lock] = OrderedDict()
+        # builds running or waiting per name, names in use are never dropped
+        self.assembler_users: Counter[str] = Counter()
+        self.assembler_locks_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers)
+        self.methods = {
+            "disassemble": self.disassemble,
+            "assemble": self.assemble,
+            "roundtrip": self.roundtrip,
+            "validate": self.validate,
+            "stats": self.stats,
+        }
+        self.latencies: dict[str, deque[float]] = {method: deque(maxlen=LATENCY_WINDOW) for method in self.methods}
+        self.counts: dict[str, int] = {method: 0 for method in self.methods}
+        self.errors: dict[str, int] = {method: 0 for method in self.methods}
+
+    def _input_bytes(self, params: dict) -> bytes:
+        if "path" in params:
+            return self.files.read(params["path"])
+        if "data" in params:
+            return base64.b64decode(params["data"])
+        raise RequestError(INVALID_PARAMS, "Expected path or data")
+
+    def _result(self, params: dict, kind: str, compute: Callable[[bytes], Any]) -> Any:
+        """
+        compute for the input bytes, cached with the file when they come from a path.
+        """
+        if "path" in params:
+            return self.files.result(params["path"], kind, compute)
+        return compute(self._input_bytes(params))
+
+    def _input_text(self, params: dict) -> tuple[list[str], str]:
+        if "path" in params:
+            return self.files.read(params["path"]).decode().splitlines(), params.get("name", params["path"])
+        if "text" in params:
+            return params["text"].splitlines(), params.get("name", "")
+        raise RequestError(INVALID_PARAMS, "Expected path or text")
+
+    def _assemble(self, lines: list[str], name: str) -> bytes:
+        with self.assembler_locks_lock:
+            lock = self.assembler_locks.setdefault(name, threading.Lock())
+            self.assembler_locks.move_to_end(name)
+            self.assembler_users[name] += 1
+            self._drop_assembler_names()
+        try:
+            with lock:
+                return self.assembler.assemble_lines(lines, name)
+        finally:
+            with self.assembler_locks_lock:
+                self.assembler_users[name] -= 1
+                if self.assembler_users[name] == 0:
+                    del self.assembler_users[name]
+
+    def _drop_assembler_names(self):
+        """
+        Forget the least recently built names beyond max_files, skipping names with builds in progress.
+        Called with assembler_locks_lock held.
+        """
+        excess = len(self.assembler_locks) - self.max_files
+        for name in list(self.assembler_locks):
+            if excess <= 0:
+                break
+            if name in self.assembler_users:
+                continue
+            del self.assembler_locks[name]
+            self.assembler.forget(name)
+            excess -= 1
+
+    def disassemble(self, params: dict) -> dict:
+        """
+        Disassemble a script file given by path or as base64 data, returning the text or writing it to dest.
+        """
+        text = self._result(params, "text", lambda data: script_editing.disassemble_bytes(data, self.tables))
+        if "dest" in params:
+            with open(params["dest"], "wt") as out:
+                out.write(text)
+            return {"output": params["dest"]}
+        return {"text": text}
+
+    def assemble(self, params: dict) -> dict:
+        """
+        Assemble an .asm file given by path or as text, returning the base64 data or writing it to dest.
+        Later builds of the same path or name only encode the blocks that changed.
+        """
+        lines, name = self._input_text(params)
+        assembly = self._assemble(lines, name)
+        if "dest" in params:
+            with open(params["dest"], "wb") as out:
+                out.write(assembly)
+            return {"output": params["dest"], "size": len(assembly)}
+        return {"data": base64.b64encode(assembly).decode(), "size": len(assembly)}
+
+    def roundtrip(self, params: dict) -> dict:
+        mismatch = self._result(params, "roundtrip", lambda data: script_editing.roundtrip_bytes(data, self.tables))
+        if mismatch is None:
+            return {"status": "ok"}
+        return {"status": "mismatch", **mismatch._asdict()}
+
+    def validate(self, params: dict) -> dict:
+        """
+        Check that an .asm file assembles, without writing anything.
+        """
+        lines, name = self._input_text(params)
+        try:
+            assembly = self._assemble(lines, name)
+        except Exception as e:
+            return {"valid": False, "error": str(e)}
+        return {"valid": True, "size": len(assembly)}
+
+    def stats(self, params: dict) -> dict:
+        """
+        Request counts and latencies in milliseconds per method, over the last LATENCY_WINDOW requests.
+        """
+        methods = {}
+        for method, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            methods[method] = {
+                "count": self.counts[method],
+                "errors": self.errors[method],
+                "mean_ms": sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+                "p50_ms": ordered[len(ordered) // 2] * 1000 if ordered else 0.0,
+                "p95_ms": ordered[len(ordered) * 95 // 100] * 1000 if ordered else 0.0,
+                "max_ms": ordered[-1] * 1000 if ordered else 0.0,
+            }
+        return {
+            "methods": methods,
+            "cached_files": len(self.files.files),
+            "cached_result_hits": self.files.result_hits,
+            "cached_result_misses": self.files.result_misses,
+            "assembler_files": len(self.assembler_locks),
+            "encoded_blocks": self.assembler.encoded_blocks,
+            "reused_blocks": self.assembler.reused_blocks,
+        }
+
+    async def handle_request(self, line: bytes) -> dict | None:
+        request_id = None
+        notification = False
+        method = None
+        start = time.perf_counter()
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                raise RequestError(PARSE_ERROR, f"Parse error: {e}")
+            if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+                raise RequestError(INVALID_REQUEST, "Invalid request")
+            request_id = request.get("id")
+            notification = "id" not in request
+            if request["method"] not in self.methods:
+                raise RequestError(METHOD_NOT_FOUND, f"Unknown method: {request['method']}")
+            method = request["method"]
+            params = request.get("params", {})
+            if not isinstance(params, dict):
+                raise RequestError(INVALID_PARAMS, "Params must be an object")
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, self.methods[method], params)
+            response = {"jsonrpc": "2.0", "id": request_id, "result": result}
+        except RequestError as e:
+            response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": e.code, "message": str(e)}}
+            if e.data is not None:
+                response["error"]["data"] = e.data
+        except Exception as e:
+            error = {"code": SERVER_ERROR, "message": repr(e.args)}
+            if isinstance(e, AddressError):
+                error["data"] = {"address": e.address}
+            response = {"jsonrpc": "2.0", "id": request_id, "error": error}
+        if method is not None:
+            self.counts[method] += 1
+            self.latencies[method].append(time.perf_counter() - start)
+            if "error" in response:
+                self.errors[method] += 1
+        # notifications (requests without an id) get no response, not even an error,
+        # only lines that are not a valid request at all are answered with a null id
+        return None if notification else response
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        write_lock = asyncio.Lock()
+        pending: set[asyncio.Task] = set()
+
+        async def respond(line: bytes):
+            response = await self.handle_request(line)
+            if response is None:
+                return
+            async with write_lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(respond(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+
+    async def serve_unix(self, path: str):
+        # a socket left behind by an earlier run is replaced, anything else is not touched
+        if os.path.lexists(path):
+            if not is_socket(path):
+                raise Exception(f"Not a socket: {path}")
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.serve_connection, path, limit=LINE_LIMIT)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=LINE_LIMIT)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        await self.serve_connection(reader, writer)
+
+
+def is_socket(path: str) -> bool:
+    return stat.S_ISSOCK(os.lstat(path).st_mode)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="JSON-RPC server that keeps the (dis)assembler warm.")
+    parser.add_argument("--socket", default=None, help="Unix socket to listen on, otherwise stdin and stdout")
+    parser.add_argument("--workers", type=int, default=4, help="threads running the requests")
+    parser.add_argument("--max-files", type=int, default=256, help="recently used files and assembled names kept in memory")
+    parser.add_argument("--table-cache", default=None, help="directory for pickled opcode tables")
+    args = parser.parse_args(argv)
+
+    if args.socket is not None and os.path.lexists(args.socket) and not is_socket(args.socket):
+        parser.error(f"--socket {args.socket} exists and is not a socket")
+
+    script_editing.table_cache_dir = args.table_cache
+    server = ScriptServer(get_opcode_tables(), args.workers, args.max_files)
+    try:
+        if args.socket is not None:
+            asyncio.run(server.serve_unix(args.socket))
+        else:
+            asyncio.run(server.serve_stdio())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
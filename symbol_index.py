@@ -0,0 +1,264 @@
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+from os import PathLike
+
+import script_editing
+from script_editing import FlowKind, LazyDisassembler, OpcodeTables, get_opcode_tables, unpack_command
+
+
+# bump it whenever the extracted data changes, so older indexes are rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, hash TEXT, scripts INTEGER,
+                                  error TEXT);
+-- every access of a work variable, flag or trainer flag, once per script that reaches the command
+CREATE TABLE IF NOT EXISTS symbols (file_id INTEGER, script INTEGER, addr INTEGER, kind TEXT, value INTEGER,
+                                    access TEXT, opcode TEXT);
+-- number of commands and actions with each name reachable from any script of a file
+CREATE TABLE IF NOT EXISTS opcodes (file_id INTEGER, name TEXT, count INTEGER);
+-- calls, jumps and actor command lists, once per script that reaches the command
+CREATE TABLE IF NOT EXISTS edges (file_id INTEGER, script INTEGER, addr INTEGER, kind TEXT, target INTEGER);
+CREATE INDEX IF NOT EXISTS symbols_value ON symbols (kind, value);
+CREATE INDEX IF NOT EXISTS symbols_file ON symbols (file_id);
+CREATE INDEX IF NOT EXISTS opcodes_name ON opcodes (name);
+CREATE INDEX IF NOT EXISTS opcodes_file ON opcodes (file_id);
+CREATE INDEX IF NOT EXISTS edges_target ON edges (file_id, target);
+"""
+
+# commands whose 2v parameter is written, for every other command it is only read
+VARIABLE_WRITERS = {"StackPop", "WorkAdd", "WorkSub", "WorkSetConst", "WorkSet", "WorkMul", "WorkDiv", "WorkMod",
+                    "WorkAnd", "WorkOr", "ListMenuInitCommon", "ListMenuInitTL", "ListMenuInitTR"}
+# commands taking a flag number as their first parameter: (kind of flag, access)
+FLAG_COMMANDS = {
+    "FlagSet": ("flag", "write"),
+    "FlagReset": ("flag", "write"),
+    "FlagGet": ("flag", "read"),
+    "StackPushFlag": ("flag", "read"),
+    "TrainerFlagSet": ("trainer_flag", "write"),
+    "TrainerFlagReset": ("trainer_flag", "write"),
+    "TrainerFlagGet": ("trainer_flag", "read"),
+}
+EDGE_KINDS = {
+    FlowKind.CALL: "call",
+    FlowKind.CALL_IF: "call",
+    FlowKind.JUMP: "jump",
+    FlowKind.JUMP_IF: "jump",
+    FlowKind.ACTOR_EXEC: "actor",
+}
+
+
+def is_variable(value: int) -> bool:
+    """
+    Whether a 2 byte parameter refers to a work variable instead of being a plain number.
+    """
+    return 0x4000 <= value < 0x4200 or 0x8000 <= value < 0x8100
+
+
+def extract(data: bytes, tables: OpcodeTables | None = None) -> tuple[int, list[tuple], Counter, list[tuple]]:
+    """
+    Walk every script of a file, returning the number of scripts, the symbol accesses
+    (script, addr, kind, value, access, opcode), the opcode counts and the edges (script, addr, kind, target).
+    """
+    lazy = LazyDisassembler(data, tables)
+    symbols = []
+    edges = []
+    reached: dict[int, str] = {}
+    for index in range(len(lazy)):
+        listing = lazy.script(index)
+        for instruction in listing.instructions:
+            addr = instruction.addr
+            if addr in listing.actions:
+                reached[addr] = instruction.op.name if instruction.op is not None else hex(instruction.code)
+                continue
+            op = instruction.op
+            reached[addr] = op.name
+            if op.flow in EDGE_KINDS:
+                edges.append((index, addr, EDGE_KINDS[op.flow], instruction.target))
+            if len(op.params) == 0:
+                continue
+            values = unpack_command(op, data, addr)[1:]
+            if op.name in FLAG_COMMANDS and not is_variable(values[0]):
+                kind, access = FLAG_COMMANDS[op.name]
+                symbols.append((index, addr, kind, values[0], access, op.name))
+            for param, value in zip(op.params, values):
+                if param[0] != "2" or not is_variable(value):
+                    continue
+                match param[1]:
+                    case "r":
+                        symbols.append((index, addr, "var", value, "write", op.name))
+                    case "v" if op.name in VARIABLE_WRITERS:
+                        symbols.append((index, addr, "var", value, "write", op.name))
+                    case "v" | "a":
+                        symbols.append((index, addr, "var", value, "read", op.name))
+    return len(lazy), symbols, Counter(reached.values()), edges
+
+
+class SymbolIndex:
+    """
+    SQLite index of the symbols, opcodes and control flow edges of a script bank.
+    Files are only walked again when their content hash changes.
+    """
+
+    def __init__(self, f: PathLike | str, tables: OpcodeTables | None = None):
+        if tables is None:
+            tables = get_opcode_tables()
+        self.tables = tables
+        self.db = sqlite3.connect(f)
+        self.db.executescript(SCHEMA)
+        # results depend on the opcode tables too, so edited tables make every file stale
+        stamp = f"{SCHEMA_VERSION} {tables.commands.source_hash} {tables.actions.source_hash}"
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+        if row is None or row[0] != stamp:
+            with self.db:
+                for table in ("files", "symbols", "opcodes", "edges"):
+                    self.db.execute(f"DELETE FROM {table}")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self) -> "SymbolIndex":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, files: list[PathLike | str]) -> dict[str, int]:
+        """
+        Index new and changed files, and drop indexed files that no longer exist.
+        Returns how many files were indexed, unchanged, failed and removed.
+        """
+        counts = {"indexed": 0, "unchanged": 0, "failed": 0, "removed": 0}
+        known = {path: (file_id, file_hash) for file_id, path, file_hash
+                 in self.db.execute("SELECT id, path, hash FROM files")}
+        with self.db:
+            for f in files:
+                path = os.path.abspath(f)
+                data = script_editing.get_file_as_bytes(f)
+                file_hash = hashlib.sha1(data).hexdigest()
+                if path in known and known[path][1] == file_hash:
+                    counts["unchanged"] += 1
+                    continue
+                if path in known:
+                    self._remove(known[path][0])
+                try:
+                    scripts, symbols, opcodes, edges = extract(data, self.tables)
+                except Exception as e:
+                    self.db.execute("INSERT INTO files (path, hash, scripts, error) VALUES (?, ?, 0, ?)",
+                                    (path, file_hash, repr(e.args)))
+                    counts["failed"] += 1
+                    continue
+                file_id = self.db.execute("INSERT INTO files (path, hash, scripts) VALUES (?, ?, ?)",
+                                          (path, file_hash, scripts)).lastrowid
+                self.db.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    ((file_id, *symbol) for symbol in symbols))
+                self.db.executemany("INSERT INTO opcodes VALUES (?, ?, ?)",
+                                    ((file_id, name, count) for name, count in opcodes.items()))
+                self.db.executemany("INSERT INTO edges VALUES (?, ?, ?, ?, ?)",
+                                    ((file_id, *edge) for edge in edges))
+                counts["indexed"] += 1
+            for path, (file_id, _) in known.items():
+                if not os.path.exists(path):
+                    self._remove(file_id)
+                    counts["removed"] += 1
+        return counts
+
+    def _remove(self, file_id: int):
+        for table in ("symbols", "opcodes", "edges"):
+            self.db.execute(f"DELETE FROM {table} WHERE file_id = ?", (file_id,))
+        self.db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def symbol_accesses(self, kind: str, value: int, access: str | None = None) -> list[dict]:
+        """
+        Every script that reads or writes a work variable ("var"), a flag ("flag") or a trainer flag
+        ("trainer_flag"), optionally only reads or only writes.
+        """
+        query = ("SELECT path, script, addr, access, opcode FROM symbols JOIN files ON files.id = file_id"
+                 " WHERE kind = ? AND value = ?")
+        params: list = [kind, value]
+        if access is not None:
+            query += " AND access = ?"
+            params.append(access)
+        query += " ORDER BY path, script, addr"
+        return [{"file": path, "script": script, "addr": addr, "access": access, "opcode": opcode}
+                for path, script, addr, access, opcode in self.db.execute(query, params)]
+
+    def opcode_counts(self, name: str | None = None) -> list[dict]:
+        """
+        Usage of one opcode by file, or the usage of every opcode over the whole bank.
+        """
+        if name is None:
+            return [{"opcode": name, "count": count, "files": files} for name, count, files in self.db.execute(
+                "SELECT name, SUM(count), COUNT(*) FROM opcodes GROUP BY name ORDER BY SUM(count) DESC, name")]
+        return [{"file": path, "count": count} for path, count in self.db.execute(
+            "SELECT path, count FROM opcodes JOIN files ON files.id = file_id WHERE name = ? ORDER BY path",
+            (name,))]
+
+    def edges(self, f: PathLike | str, target: int | None = None) -> list[dict]:
+        """
+        The calls, jumps and actor command lists of a file, optionally only the ones to target.
+        """
+        query = ("SELECT script, addr, kind, target FROM edges JOIN files ON files.id = file_id"
+                 " WHERE path = ?")
+        params: list = [os.path.abspath(f)]
+        if target is not None:
+            query += " AND target = ?"
+            params.append(target)
+        query += " ORDER BY script, addr"
+        return [{"script": script, "addr": addr, "kind": kind, "target": target}
+                for script, addr, kind, target in self.db.execute(query, params)]
+
+    def errors(self) -> list[dict]:
+        return [{"file": path, "error": error}
+                for path, error in self.db.execute("SELECT path, error FROM files WHERE error IS NOT NULL")]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Index and query the flags, work variables, opcodes and"
+                                                 " control flow of a script bank.")
+    parser.add_argument("index", help="SQLite file of the index")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    update = subparsers.add_parser("update", help="index new and changed script files")
+    update.add_argument("inputs", nargs="+", help="script files, directories or glob patterns")
+    for kind in ("var", "flag", "trainer-flag"):
+        symbol = subparsers.add_parser(kind, help=f"scripts that read or write a {kind.replace('-', ' ')}")
+        symbol.add_argument("value", help="number, like 0x4021 or 2400")
+        symbol.add_argument("--access", choices=("read", "write"), default=None)
+    opcode = subparsers.add_parser("opcode", help="usage counts of one opcode by file, or of every opcode")
+    opcode.add_argument("name", nargs="?", default=None)
+    edges = subparsers.add_parser("edges", help="calls, jumps and actor command lists of a file")
+    edges.add_argument("file", help="indexed script file")
+    edges.add_argument("--target", default=None, help="only edges to this address")
+    subparsers.add_parser("errors", help="indexed files that could not be walked")
+    args = parser.parse_args(argv)
+
+    with SymbolIndex(args.index) as index:
+        start = time.perf_counter()
+        match args.mode:
+            case "update":
+                results = [index.update(script_editing.expand_inputs(args.inputs))]
+            case "var" | "flag" | "trainer-flag":
+                results = index.symbol_accesses(args.mode.replace("-", "_"), int(args.value, 0), args.access)
+            case "opcode":
+                results = index.opcode_counts(args.name)
+            case "edges":
+                results = index.edges(args.file, int(args.target, 0) if args.target is not None else None)
+            case _:
+                results = index.errors()
+        for result in results:
+            sys.stdout.write(json.dumps(result) + "\n")
+        print(f"{len(results)} results in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+import benchmark
+import script_editing
+from script_editing import FlowKind
+
+
+def build(assemble, lines):
+    try:
+        return bytes(assemble(lines))
+    except Exception as e:
+        return e.args
+
+
+def edit(rng, tables, lines):
+    """
+    A random edit like the ones of a modder: a changed parameter, a new command, action or raw byte, or a deleted line.
+    """
+    start = lines.index("# commands") + 1
+    i = rng.randrange(start, len(lines))
+    r = rng.random()
+    if r < 0.4:
+        words = lines[i].split()
+        op = tables.commands.by_name.get(words[0]) if lines[i].startswith("    ") and len(words) > 0 else None
+        if op is not None and op.widths and op.flow == FlowKind.NONE:
+            words[rng.randrange(len(op.widths)) + 1] = str(rng.randrange(256))
+            lines[i] = "    " + " ".join(words)
+    elif r < 0.6:
+        op = rng.choice([op for op in tables.commands.by_code.values() if op.flow == FlowKind.NONE])
+        lines.insert(i + 1, "    " + " ".join([op.name] + ["1"] * len(op.widths)))
+    elif r < 0.7:
+        lines.insert(i + 1, f"     {rng.choice(list(tables.actions.by_code.values())).name} 3")
+    elif r < 0.8:
+        lines.insert(i + 1, f"    _{hex(rng.randrange(256))}")
+    elif not lines[i].lstrip().startswith("#"):
+        del lines[i]
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_incremental_matches_full_build(seed):
+    rng = random.Random(seed)
+    tables = script_editing.get_opcode_tables()
+    assembler = script_editing.IncrementalAssembler(tables)
+    for f in range(3):
+        name = f"{seed}_{f}"
+        data = bytes(script_editing.assemble_lines(
+            benchmark.generate_asm(rng, tables, rng.randrange(1, 6), rng.randrange(10, 60), 0.25, 4), tables))
+        # the disassembly has labels, actions and raw bytes, like the files that are edited
+        lines = script_editing.disassemble_bytes(data, tables).splitlines()
+        for _ in range(25):
+            edit(rng, tables, lines)
+            full = build(lambda lines: script_editing.assemble_lines(lines, tables), lines)
+            assert build(lambda lines: assembler.assemble_lines(lines, name), lines) == full
+    assert assembler.reused_blocks > 0
+
+
+def test_incremental_forget():
+    tables = script_editing.get_opcode_tables()
+    lines = benchmark.generate_asm(random.Random(0), tables, 3, 40, 0.25, 4)
+    assembler = script_editing.IncrementalAssembler(tables)
+    first = assembler.assemble_lines(lines, "a")
+    assembler.forget("a")
+    encoded = assembler.encoded_blocks
+    assert assembler.assemble_lines(lines, "a") == first == bytes(script_editing.assemble_lines(lines, tables))
+    assert assembler.encoded_blocks > encoded
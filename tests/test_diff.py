@@ -0,0 +1,23 @@
+import random
+
+import pytest
+
+import benchmark
+import script_diff
+import script_editing
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_reports_exactly_the_edits(seed):
+    result = benchmark.bench_diff(60, 0.5, seed)
+    assert result["edited_files"] > 0
+    assert result["missed_insertions"] == 0
+    assert result["found_retargets"] == result["retargeted_files"]
+    assert result["unexpected_changes"] == 0
+
+
+def test_identical_files():
+    tables = script_editing.get_opcode_tables()
+    lines = benchmark.generate_asm(random.Random(0), tables, 3, 40, 0.25, 4)
+    data = bytes(script_editing.assemble_lines(lines, tables))
+    assert script_diff.diff_bytes(data, data, tables) == []
@@ -0,0 +1,80 @@
+import json
+import random
+
+import pytest
+
+import benchmark
+import script_editing
+
+SCRIPTS = """0 scr0
+1 scr1
+# commands
+
+# scr0
+    VMJumpIf 1 lbl1-1
+    ActorCmdExec 0x4000 act1-2
+    VMHalt
+
+   # lbl1-1
+    VMCall sub3
+    VMHalt
+
+   # act1-2
+     LookUp 1
+     EndAction 0
+
+# sub3
+    VMReturn
+
+# scr1
+    VMCall sub3
+    VMJump lbl1-1
+"""
+
+
+@pytest.fixture(scope="module")
+def tables():
+    return script_editing.get_opcode_tables()
+
+
+def test_iter_script(tables):
+    lazy = script_editing.LazyDisassembler(bytes(script_editing.assemble_lines(SCRIPTS.splitlines(), tables)), tables)
+    assert len(lazy) == 2
+    assert list(lazy.iter_script(1)) == [
+        "# lbl_1b", "    VMCall sub_2c", "    VMHalt", "",
+        "# sub_2c", "    VMReturn", "",
+        "# scr1", "    VMCall sub_2c", "    VMJump lbl_1b",
+    ]
+    decoded = len(lazy.walker.decoded_commands)
+    listing = lazy.script(0)
+    assert [line for line in lazy.iter_script(0) if line.startswith("     ")] == ["     LookUp 1", "     EndAction 0"]
+    assert listing.actions == {0x24, 0x28}
+    # scr0 only adds its own commands, the ones it shares with scr1 are not decoded again
+    assert len(lazy.walker.decoded_commands) == decoded + 3
+    assert lazy.script(0) is listing
+    with pytest.raises(Exception, match="out of range"):
+        lazy.script(2)
+
+
+def test_covers_full_analysis(tables):
+    rng = random.Random(0)
+    for _ in range(40):
+        lines = benchmark.generate_asm(rng, tables, rng.randrange(1, 8), rng.randrange(10, 100), 0.25, 4)
+        data = bytes(script_editing.assemble_lines(lines, tables))
+        scripts, walker = script_editing.analyze(data, tables)
+        full = {instruction.addr: instruction for block in walker.basic_blocks().values()
+                for instruction in block.instructions}
+        lazy = script_editing.LazyDisassembler(data, tables)
+        reached = {instruction.addr: instruction for index in range(len(lazy))
+                   for instruction in lazy.script(index).instructions}
+        # every instruction of the full disassembly is reached from some script, and decoded the same
+        assert all(reached.get(addr) == instruction for addr, instruction in full.items())
+
+
+def test_cli_error(tmp_path, capsys):
+    (tmp_path / "a.bin").write_bytes(bytes(script_editing.assemble_lines(SCRIPTS.splitlines())))
+    assert script_editing.main(["script", str(tmp_path / "a.bin"), "1"]) == 0
+    assert capsys.readouterr().out.splitlines()[-1] == "    VMJump lbl_1b"
+    assert script_editing.main(["script", str(tmp_path / "a.bin"), "5"]) == 1
+    result = json.loads(capsys.readouterr().out)
+    assert (result["mode"], result["script"], result["status"]) == ("script", 5, "error")
@@ -0,0 +1,96 @@
+import json
+import random
+
+import pytest
+
+import benchmark
+import narc
+import script_editing
+
+
+def members(count):
+    rng = random.Random(0)
+    tables = script_editing.get_opcode_tables()
+    return [bytes(script_editing.assemble_lines(benchmark.generate_asm(rng, tables, 2, 20, 0.25, 2), tables))
+            for _ in range(count)]
+
+
+def summary(tmp_path, *argv):
+    """
+    Run the CLI in this process, returning its exit code and summary lines.
+    """
+    code = script_editing.main(["-j", "1", "--summary", str(tmp_path / "summary.jsonl"), *map(str, argv)])
+    with open(tmp_path / "summary.jsonl") as infile:
+        return code, [json.loads(line) for line in infile]
+
+
+def test_build_and_read(tmp_path):
+    # odd sizes, so the members need padding
+    files = [b"abc", b"", b"defgh", bytes(range(256))]
+    narc.write_narc(tmp_path / "a.narc", files, padding=0)
+    with narc.Narc(tmp_path / "a.narc") as container:
+        assert [bytes(member) for member in container.members] == files
+        assert container.padding == 0
+        assert b"".join(narc.build_narc(container.members, container.name_table, container.padding,
+                                        container.version)) == (tmp_path / "a.narc").read_bytes()
+
+
+@pytest.mark.parametrize("size", [0, 10, 30])
+def test_truncated(tmp_path, size):
+    narc.write_narc(tmp_path / "a.narc", [b"abcd"] * 4)
+    (tmp_path / "b.narc").write_bytes((tmp_path / "a.narc").read_bytes()[:size])
+    with pytest.raises(Exception, match="Not a NARC archive"):
+        narc.Narc(tmp_path / "b.narc")
+
+
+def test_member_spec():
+    assert script_editing.parse_member_spec("0-6:3,8", 10) == [0, 3, 6, 8]
+    assert script_editing.parse_member_spec(None, 3) == [0, 1, 2]
+    with pytest.raises(Exception, match="Bad member selection"):
+        script_editing.parse_member_spec("1-x", 10)
+    with pytest.raises(Exception, match="out of range"):
+        script_editing.parse_member_spec("9-10", 10)
+
+
+def test_cli_roundtrip(tmp_path):
+    files = members(6)
+    narc.write_narc(tmp_path / "a.narc", files)
+    code, results = summary(tmp_path, "disassemble-narc", tmp_path / "a.narc", "-o", tmp_path / "asm",
+                            "--members", "0-4:2")
+    assert code == 0
+    assert [result["member"] for result in results] == [0, 2, 4]
+    assert sorted(path.name for path in (tmp_path / "asm").iterdir()) == ["000.asm", "002.asm", "004.asm"]
+
+    # the names written for extracted files work as well
+    (tmp_path / "asm" / "002.asm").rename(tmp_path / "asm" / "7_2.asm")
+    lines = (tmp_path / "asm" / "004.asm").read_text().splitlines()
+    lines.insert(lines.index("# scr0") + 1, "    VMSleep 1")
+    (tmp_path / "asm" / "004.asm").write_text("\n".join(lines) + "\n")
+    code, results = summary(tmp_path, "assemble-narc", tmp_path / "a.narc", tmp_path / "asm", "-o", tmp_path / "b.narc")
+    assert code == 0
+    assert [result["member"] for result in results] == [0, 2, 4]
+    with narc.Narc(tmp_path / "b.narc") as container:
+        assert [i for i, member in enumerate(container.members) if bytes(member) != files[i]] == [4]
+
+    code, results = summary(tmp_path, "roundtrip-narc", tmp_path / "b.narc")
+    assert code == 0
+    assert all(result["status"] == "ok" for result in results)
+
+
+def test_cli_unmatched_files(tmp_path):
+    narc.write_narc(tmp_path / "a.narc", members(3))
+    summary(tmp_path, "disassemble-narc", tmp_path / "a.narc", "-o", tmp_path / "asm")
+    (tmp_path / "asm" / "7_1.asm").write_text((tmp_path / "asm" / "001.asm").read_text())
+    (tmp_path / "asm" / "9.asm").write_text("")
+    code, results = summary(tmp_path, "assemble-narc", tmp_path / "a.narc", tmp_path / "asm", "-o", tmp_path / "b.narc")
+    assert code == 1
+    assert sorted(result["file"].rpartition("/")[2] for result in results if result["status"] == "error") \
+        == ["7_1.asm", "9.asm"]
+    assert not (tmp_path / "b.narc").exists()
+
+
+def test_cli_bad_archive(tmp_path):
+    (tmp_path / "a.narc").write_bytes(b"NARC")
+    code, results = summary(tmp_path, "roundtrip-narc", tmp_path / "a.narc")
+    assert code == 1
+    assert results[0]["status"] == "error"
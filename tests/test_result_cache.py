@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+
+import script_editing
+from result_cache import ResultCache
+
+
+def test_keys(tmp_path):
+    cache_a = ResultCache(tmp_path, salt=b"a")
+    cache_b = ResultCache(tmp_path, salt=b"b")
+    assert cache_a.key("asm", b"data") == cache_a.key("asm", memoryview(b"data"))
+    assert len({cache_a.key("asm", b"data"), cache_a.key("bin", b"data"), cache_a.key("asm", b"datb"),
+                cache_b.key("asm", b"data")}) == 4
+
+
+def test_table_salt(tmp_path):
+    shutil.copy(script_editing.COMMANDS_FILE, tmp_path / "commands.txt")
+    with open(tmp_path / "commands.txt", "at") as out:
+        out.write("\n")
+    edited = script_editing.get_opcode_tables(tmp_path / "commands.txt")
+    assert script_editing.open_result_cache(tmp_path / "a", 1 << 20).key("asm", b"data") \
+        != script_editing.open_result_cache(tmp_path / "b", 1 << 20, edited).key("asm", b"data")
+
+
+def test_hits_and_misses(tmp_path):
+    cache = ResultCache(tmp_path, 1 << 20)
+    key = cache.key("asm", b"data")
+    assert cache.get(key, "asm") is None
+    cache.put(key, "asm", b"result")
+    assert cache.get(key, "asm") == b"result"
+    assert cache.get(key, "bin") is None
+    assert not cache.copy_to(cache.key("asm", b"other"), "asm", tmp_path / "out")
+    assert cache.copy_to(key, "asm", tmp_path / "out")
+    assert (tmp_path / "out").read_bytes() == b"result"
+    assert (cache.hits, cache.misses) == (2, 3)
+    # another process sees the same entries
+    assert ResultCache(tmp_path, 1 << 20).get(key, "asm") == b"result"
+
+
+def test_eviction(tmp_path):
+    cache = ResultCache(tmp_path, 4000)
+    keys = [cache.key("bin", bytes([i])) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, "bin", bytes(1000))
+        # the last use decides what is evicted, so give every entry its own time
+        os.utime(cache.path(key, "bin"), ns=(i * 10**9, i * 10**9))
+    # using the oldest entry makes it the most recently used of them
+    os.utime(cache.path(keys[0], "bin"), ns=(10 * 10**9, 10 * 10**9))
+    # past max_bytes, entries are deleted down to three quarters of it
+    cache.put(cache.key("bin", b"new"), "bin", bytes(1500))
+    assert cache.evictions == 2
+    assert cache.stats()["bytes"] == 2500
+    assert cache.get(keys[1], "bin") is None
+    assert cache.get(keys[2], "bin") is None
+    assert cache.get(keys[0], "bin") is not None
+
+
+def test_cli(tmp_path, monkeypatch):
+    # main() opens the cache for this process
+    monkeypatch.setattr(script_editing, "result_cache", None)
+    (tmp_path / "in").mkdir()
+    shutil.copy(script_editing.COMMANDS_FILE, tmp_path / "in" / "not_a_script")
+    lines = ["0 scr0", "# commands", "", "# scr0", "    VMCall sub1", "    VMHalt", "", "# sub1", "    VMReturn"]
+    (tmp_path / "in.asm").write_text("\n".join(lines) + "\n")
+    script_editing.main(["-j", "1", "--summary", str(tmp_path / "s"), "assemble", str(tmp_path / "in.asm"),
+                         "-o", str(tmp_path / "in")])
+
+    def run(*argv):
+        code = script_editing.main(["-j", "1", "--cache", str(tmp_path / "cache"), "--summary", str(tmp_path / "s"),
+                                    *argv])
+        with open(tmp_path / "s") as infile:
+            return code, [(result["status"], result.get("cache")) for result in map(json.loads, infile)]
+
+    assert run("disassemble", str(tmp_path / "in" / "in.bin"), "-o", str(tmp_path / "out")) == (0, [("ok", "miss")])
+    os.remove(tmp_path / "out" / "in.asm")
+    assert run("disassemble", str(tmp_path / "in" / "in.bin"), "-o", str(tmp_path / "out")) == (0, [("ok", "hit")])
+    assert (tmp_path / "out" / "in.asm").read_text().splitlines() == lines
+    # round trips are remembered, failures are checked again
+    for cache in ("miss", "hit"):
+        assert run("roundtrip", str(tmp_path / "in")) == (1, [("ok", cache), ("error", "miss")])
@@ -0,0 +1,148 @@
+import random
+
+import pytest
+
+import benchmark
+import script_editing
+from script_editing import ControlFlowWalker, read_script_table
+
+# every kind of branch, a subroutine shared by two scripts, a backwards jump and an action list
+BRANCHES = """0 scr0
+1 scr1
+# commands
+
+# scr0
+    VMJumpIf 1 lbl1-1
+    VMCallIf 2 sub2
+    ActorCmdExec 0x4000 act1-3
+    VMJump lbl1-4
+
+   # lbl1-1
+    VMCall sub2
+    VMHalt
+
+# sub2
+    VMReturn
+
+   # act1-3
+     LookUp 1
+     WalkN32F 2
+     EndAction 0
+
+   # lbl1-4
+    VMJumpIf 0 lbl1-1
+    VMHalt
+
+# scr1
+    VMCall sub2
+    VMJump lbl1-4
+"""
+
+
+def roundtrip(tmp_path, text):
+    """
+    Assemble text, then disassemble and reassemble the result. Returns the two builds and the disassembly.
+    """
+    (tmp_path / "a.asm").write_text(text)
+    script_editing.assemble(tmp_path / "a.asm", tmp_path / "a.bin")
+    script_editing.disassemble(tmp_path / "a.bin", tmp_path / "b.asm")
+    script_editing.assemble(tmp_path / "b.asm", tmp_path / "b.bin")
+    return (tmp_path / "a.bin").read_bytes(), (tmp_path / "b.bin").read_bytes(), (tmp_path / "b.asm").read_text()
+
+
+def test_branches(tmp_path):
+    data, reassembled, text = roundtrip(tmp_path, BRANCHES)
+    assert reassembled == data
+    walker = ControlFlowWalker(data)
+    walker.walk_scripts(read_script_table(data))
+    blocks = walker.basic_blocks()
+    assert set(walker.links) <= set(blocks)
+    assert any(block.is_action for block in blocks.values())
+    # every instruction is in one block at most
+    addrs = [instruction.addr for block in blocks.values() for instruction in block.instructions]
+    assert len(addrs) == len(set(addrs))
+
+
+def test_deep_calls(tmp_path):
+    # a chain of subroutines far deeper than the recursion limit
+    lines = ["0 scr0", "# commands", "", "# scr0", "    VMCall sub1", "    VMHalt"]
+    for i in range(1, 5000):
+        lines += ["", f"# sub{i}", f"    VMCall sub{i + 1}", "    VMReturn"]
+    lines += ["", "# sub5000", "    VMReturn"]
+    data, reassembled, text = roundtrip(tmp_path, "\n".join(lines) + "\n")
+    assert reassembled == data
+    assert text.splitlines() == lines
+    walker = ControlFlowWalker(data)
+    walker.walk_scripts(read_script_table(data))
+    assert len(walker.links) == 5001
+    assert set(walker.links) <= set(walker.basic_blocks())
+
+
+@pytest.fixture(scope="module")
+def tables():
+    return script_editing.get_opcode_tables()
+
+
+def generated(rng, tables, files):
+    for _ in range(files):
+        lines = benchmark.generate_asm(rng, tables, rng.randrange(1, 8), rng.randrange(10, 100),
+                                       rng.choice((0.05, 0.25)), rng.randrange(16))
+        yield bytes(script_editing.assemble_lines(lines, tables))
+
+
+def expand_hex(text):
+    """
+    The disassembly with every _hex line written as single _0xNN lines.
+    """
+    lines = []
+    for line in text.splitlines():
+        words = line.split()
+        if len(words) == 2 and words[0] == "_hex":
+            lines.extend(f"    _{hex(byte)}" for byte in bytes.fromhex(words[1]))
+        else:
+            lines.append(line)
+    return lines
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_generated(tables, seed):
+    for data in generated(random.Random(seed), tables, 40):
+        assert script_editing.roundtrip_bytes(data, tables) is None
+        # reassembling the disassembly gives the same disassembly again
+        text = script_editing.disassemble_bytes(data, tables)
+        reassembled = bytes(script_editing.assemble_lines(text.splitlines(), tables))
+        assert script_editing.disassemble_bytes(reassembled, tables) == text
+
+
+@pytest.mark.parametrize("kind", benchmark.STRESS_KINDS)
+def test_pathological(tables, kind):
+    rng = random.Random(0)
+    for size in (500, 4000):
+        assert script_editing.roundtrip_bytes(benchmark.generate_pathological(rng, kind, size), tables) is None
+
+
+def test_mutated(tables):
+    rng = random.Random(0)
+    checked = 0
+    for data in generated(rng, tables, 60):
+        data = bytearray(data)
+        for _ in range(rng.randrange(1, 8)):
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        try:
+            mismatch = script_editing.roundtrip_bytes(bytes(data), tables)
+        except Exception:
+            # labels in the middle of other code and broken tables are reported, not written wrong
+            continue
+        assert mismatch is None
+        checked += 1
+    assert checked > 0
+
+
+def test_hex_lines(tables):
+    rng = random.Random(1)
+    raw = 0
+    for data in generated(rng, tables, 20):
+        text = script_editing.disassemble_bytes(data, tables)
+        raw += text.count("_hex")
+        assert bytes(script_editing.assemble_lines(expand_hex(text), tables)) == data
+    assert raw > 0
@@ -0,0 +1,138 @@
+import asyncio
+import base64
+import json
+import os
+import socket
+
+import pytest
+
+import script_editing
+import server
+
+SCRIPT = ["0 scr0", "# commands", "", "# scr0", "    VMCall sub1", "    VMHalt", "", "# sub1", "    VMReturn"]
+
+
+@pytest.fixture
+def script_server():
+    script_server = server.ScriptServer(script_editing.get_opcode_tables(), 2, 2)
+    yield script_server
+    script_server.executor.shutdown()
+
+
+def call(script_server, *requests):
+    """
+    Send requests (dicts, or raw lines) concurrently, returning the responses in request order.
+    """
+    lines = [request if isinstance(request, bytes) else json.dumps(request).encode() for request in requests]
+
+    async def send():
+        return await asyncio.gather(*(script_server.handle_request(line) for line in lines))
+    return asyncio.run(send())
+
+
+def request(request_id, method, **params):
+    return {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+
+
+def test_methods(script_server, tmp_path):
+    data = bytes(script_editing.assemble_lines(SCRIPT))
+    (tmp_path / "a.bin").write_bytes(data)
+    assembled, disassembled, roundtrip, valid, invalid = call(
+        script_server,
+        request(1, "assemble", text="\n".join(SCRIPT), name="a"),
+        request(2, "disassemble", data=base64.b64encode(data).decode()),
+        request(3, "roundtrip", path=str(tmp_path / "a.bin")),
+        request(4, "validate", text="\n".join(SCRIPT)),
+        request(5, "validate", text="\n".join(SCRIPT + ["    NoSuchCommand"])),
+    )
+    assert [response["id"] for response in (assembled, disassembled, roundtrip, valid, invalid)] == [1, 2, 3, 4, 5]
+    assert base64.b64decode(assembled["result"]["data"]) == data
+    assert disassembled["result"]["text"].splitlines() == SCRIPT
+    assert roundtrip["result"] == {"status": "ok"}
+    assert valid["result"] == {"valid": True, "size": len(data)}
+    assert invalid["result"]["valid"] is False
+
+    call(script_server, request(6, "assemble", text="\n".join(SCRIPT[:-1] + ["    VMHalt"]), name="a",
+                                dest=str(tmp_path / "b.bin")))
+    assert (tmp_path / "b.bin").read_bytes() == bytes(script_editing.assemble_lines(SCRIPT[:-1] + ["    VMHalt"]))
+    # only the changed block was encoded again
+    assert script_server.assembler.reused_blocks > 0
+
+
+def test_errors(script_server, tmp_path):
+    (tmp_path / "bad.bin").write_bytes(bytes(script_editing.assemble_lines(["0 scr0", "# commands", "# scr0",
+                                                                             "    _hex ffff"])))
+    unknown, params, missing, address, parse, invalid = call(
+        script_server,
+        request(1, "nope"),
+        {"jsonrpc": "2.0", "id": 2, "method": "disassemble", "params": []},
+        request(3, "disassemble"),
+        request(4, "disassemble", path=str(tmp_path / "bad.bin")),
+        b"{bad",
+        b"[1]",
+    )
+    assert unknown["error"]["code"] == server.METHOD_NOT_FOUND
+    assert params["error"]["code"] == server.INVALID_PARAMS
+    assert missing["error"]["code"] == server.INVALID_PARAMS
+    assert address["error"]["code"] == server.SERVER_ERROR and "address" in address["error"]["data"]
+    assert (parse["id"], parse["error"]["code"]) == (None, server.PARSE_ERROR)
+    assert (invalid["id"], invalid["error"]["code"]) == (None, server.INVALID_REQUEST)
+    # notifications get no response, not even an error
+    assert call(script_server, {"jsonrpc": "2.0", "method": "stats"}, {"jsonrpc": "2.0", "method": "nope"},
+                {"jsonrpc": "2.0", "method": "disassemble", "params": {"path": str(tmp_path / "missing")}}) \
+        == [None, None, None]
+    stats = call(script_server, request(5, "stats"))[0]["result"]
+    assert stats["methods"]["disassemble"]["errors"] == 4
+
+
+def test_caches(script_server, tmp_path):
+    data = bytes(script_editing.assemble_lines(SCRIPT))
+    (tmp_path / "a.bin").write_bytes(data)
+    for _ in range(2):
+        call(script_server, request(1, "disassemble", path=str(tmp_path / "a.bin")))
+    # a changed file is read and disassembled again
+    (tmp_path / "a.bin").write_bytes(data + b"\x00")
+    text = call(script_server, request(2, "disassemble", path=str(tmp_path / "a.bin")))[0]["result"]["text"]
+    assert text.splitlines()[-1] == "    _0x0"
+    for i in range(5):
+        (tmp_path / f"{i}.asm").write_text("\n".join(SCRIPT))
+        call(script_server, request(3, "assemble", path=str(tmp_path / f"{i}.asm")))
+    stats = call(script_server, request(4, "stats"))[0]["result"]
+    assert (stats["cached_result_hits"], stats["cached_result_misses"]) == (1, 2)
+    # files and assembler caches are limited to max_files
+    assert stats["cached_files"] == 2
+    assert stats["assembler_files"] == 2
+    assert len(script_server.assembler.encoded) == 2
+
+
+def test_unix_socket(script_server, tmp_path):
+    path = str(tmp_path / "server.sock")
+    # a socket left behind by an earlier run
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    async def session():
+        task = asyncio.create_task(script_server.serve_unix(path))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+                break
+            except OSError:
+                continue
+        writer.write(json.dumps({"jsonrpc": "2.0", "method": "stats"}).encode() + b"\n")
+        writer.write(json.dumps(request(1, "stats")).encode() + b"\n")
+        response = json.loads(await reader.readline())
+        writer.close()
+        task.cancel()
+        return response
+
+    assert asyncio.run(session())["id"] == 1
+    assert not os.path.exists(path)
+
+    # anything else at the path is left alone
+    (tmp_path / "commands.txt").write_text("keep")
+    with pytest.raises(Exception, match="Not a socket"):
+        asyncio.run(script_server.serve_unix(str(tmp_path / "commands.txt")))
+    assert (tmp_path / "commands.txt").read_text() == "keep"
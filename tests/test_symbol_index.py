@@ -0,0 +1,83 @@
+import os
+
+import script_editing
+from symbol_index import SymbolIndex
+
+SCRIPTS = """0 scr0
+1 scr1
+# commands
+
+# scr0
+    FlagSet 2400
+    FlagGet 0x4001 0x8000
+    WorkSetConst 0x4021 5
+    VMCall sub2
+    VMHalt
+
+# sub2
+    WorkAdd 0x4022 0x4021
+    TrainerFlagSet 12
+    VMReturn
+
+# scr1
+    FlagGet 2400 0x8001
+    VMCall sub2
+    VMHalt
+"""
+
+
+def write_script(path, text):
+    path.write_bytes(bytes(script_editing.assemble_lines(text.splitlines())))
+
+
+def accesses(index, kind, value, access=None):
+    return [(result["script"], result["access"], result["opcode"])
+            for result in index.symbol_accesses(kind, value, access)]
+
+
+def test_symbols(tmp_path):
+    write_script(tmp_path / "a.bin", SCRIPTS)
+    with SymbolIndex(tmp_path / "index.db") as index:
+        assert index.update([tmp_path / "a.bin"])["indexed"] == 1
+        assert accesses(index, "flag", 2400) == [(0, "write", "FlagSet"), (1, "read", "FlagGet")]
+        # a flag number in a variable is a variable read, not a flag
+        assert accesses(index, "flag", 0x4001) == []
+        assert accesses(index, "var", 0x4001) == [(0, "read", "FlagGet")]
+        assert accesses(index, "var", 0x8001) == [(1, "write", "FlagGet")]
+        # the subroutine is reached from both scripts
+        assert accesses(index, "var", 0x4021) == [(0, "write", "WorkSetConst"), (0, "read", "WorkAdd"),
+                                                  (1, "read", "WorkAdd")]
+        assert accesses(index, "var", 0x4021, "write") == [(0, "write", "WorkSetConst")]
+        assert accesses(index, "var", 0x4022) == [(0, "write", "WorkAdd"), (1, "write", "WorkAdd")]
+        assert accesses(index, "trainer_flag", 12) == [(0, "write", "TrainerFlagSet"), (1, "write", "TrainerFlagSet")]
+        # every command is counted once, no matter how many scripts reach it
+        assert index.opcode_counts("VMCall") == [{"file": os.path.abspath(tmp_path / "a.bin"), "count": 2}]
+        assert {result["opcode"]: result["count"] for result in index.opcode_counts()}["WorkAdd"] == 1
+        calls = index.edges(tmp_path / "a.bin")
+        assert [(edge["script"], edge["kind"]) for edge in calls] == [(0, "call"), (1, "call")]
+        assert calls[0]["target"] == calls[1]["target"]
+        assert len(index.edges(tmp_path / "a.bin", calls[0]["target"] + 1)) == 0
+
+
+def test_update(tmp_path):
+    write_script(tmp_path / "a.bin", SCRIPTS)
+    write_script(tmp_path / "b.bin", SCRIPTS)
+    with SymbolIndex(tmp_path / "index.db") as index:
+        assert index.update([tmp_path / "a.bin", tmp_path / "b.bin"]) \
+            == {"indexed": 2, "unchanged": 0, "failed": 0, "removed": 0}
+    with SymbolIndex(tmp_path / "index.db") as index:
+        write_script(tmp_path / "b.bin", SCRIPTS.replace("FlagSet 2400", "FlagSet 2401"))
+        assert index.update([tmp_path / "a.bin", tmp_path / "b.bin"]) \
+            == {"indexed": 1, "unchanged": 1, "failed": 0, "removed": 0}
+        assert [result["file"] for result in index.symbol_accesses("flag", 2401)] \
+            == [os.path.abspath(tmp_path / "b.bin")]
+        assert len(index.symbol_accesses("flag", 2400, "write")) == 1
+
+        os.remove(tmp_path / "a.bin")
+        # a script starting with an unknown command
+        write_script(tmp_path / "c.bin", "0 scr0\n# commands\n# scr0\n    _hex ffff\n")
+        assert index.update([tmp_path / "b.bin", tmp_path / "c.bin"]) \
+            == {"indexed": 0, "unchanged": 1, "failed": 1, "removed": 1}
+        # only the read of b.bin is left
+        assert accesses(index, "flag", 2400) == [(1, "read", "FlagGet")]
+        assert [result["file"] for result in index.errors()] == [os.path.abspath(tmp_path / "c.bin")]